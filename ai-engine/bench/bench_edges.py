@@ -0,0 +1,170 @@
+"""
+Micro-benchmark for the postprocess_edges engines.
+
+Each engine runs in a fresh subprocess so its peak RSS is measured on its
+own: "extra MB" is how far the first run raises the peak above the decoded
+source. Wall time is the median over --repeat runs (decoding excluded).
+The ``tiled`` engine reads its source and writes its output itself, so its
+times include file I/O and encoding and "extra MB" is measured from an
+undecoded image.
+Every engine's output is compared against the ``pillow`` reference.
+
+    python bench/bench_edges.py [image] [--size 4000x3000] [--repeat 5]
+    python bench/bench_edges.py --size 20000x15000 --format ppm --engines tiled
+
+Without an image a synthetic test picture of --size is generated in
+--format (``ppm`` lets the tiled engine read regions without decoding).
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+
+import postprocess_edges
+
+
+def synthetic_image(path, width, height, seed=0):
+    """Gradient background with soft-edged shapes and a little noise."""
+    rnd = random.Random(seed)
+    im = Image.radial_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(im)
+    for _ in range(200):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        w, h = rnd.randrange(10, max(11, width // 6)), rnd.randrange(10, max(11, height // 6))
+        draw.ellipse([x, y, x + w, y + h], fill=(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+    im = im.filter(ImageFilter.GaussianBlur(1.5))
+    noise = Image.effect_noise((width, height), 6).convert("RGB")
+    Image.blend(im, noise, 0.08).save(path)
+
+
+def _reset_peak_rss():
+    """Start peak tracking from the current RSS (Linux only; otherwise a no-op)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_tiled_child(image, repeat, out_path):
+    _reset_peak_rss()
+    base = _rss_mb()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        with Image.open(image) as im:
+            postprocess_edges.enhance_edges_tiled(im, out_path)
+        times.append(time.perf_counter() - start)
+        if i == 0:
+            peak = _rss_mb()
+    print(json.dumps({
+        "engine": "tiled",
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "peak_rss_mb": peak,
+        "extra_rss_mb": peak - base,
+    }))
+
+
+def run_child(image, engine, repeat, out_path):
+    if engine == "tiled":
+        run_tiled_child(image, repeat, out_path)
+        return
+    im = Image.open(image)
+    im.load()
+    # Decoding can peak higher than the decoded image itself
+    _reset_peak_rss()
+    base = _rss_mb()
+    start = time.perf_counter()
+    out = postprocess_edges.enhance_image(im, engine)
+    times = [time.perf_counter() - start]
+    peak = _rss_mb()
+    out.save(out_path)
+    del out
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        postprocess_edges.enhance_image(im, engine)
+        times.append(time.perf_counter() - start)
+    print(json.dumps({
+        "engine": engine,
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "peak_rss_mb": peak,
+        "extra_rss_mb": peak - base,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?")
+    parser.add_argument("--size", default="4000x3000", help="synthetic image size, WxH")
+    parser.add_argument("--format", default="png", help="synthetic image format (png, ppm, tif, ...)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--engines", default=",".join(postprocess_edges.ENGINES))
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Benchmark images may well exceed Pillow's decompression bomb limit
+    Image.MAX_IMAGE_PIXELS = None
+    if args.child:
+        run_child(args.image, args.child, max(1, args.repeat), args.out)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image = args.image
+        if image is None:
+            width, height = (int(v) for v in args.size.lower().split("x"))
+            image = os.path.join(tmp, "source." + args.format)
+            synthetic_image(image, width, height)
+        with Image.open(image) as im:
+            print(f"image: {image} ({im.width}x{im.height}), repeat={args.repeat}")
+
+        results = {}
+        for engine in args.engines.split(","):
+            out_path = os.path.join(tmp, f"{engine}.png")
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), image, "--child", engine,
+                 "--repeat", str(args.repeat), "--out", out_path],
+                check=True, capture_output=True, text=True,
+            )
+            results[engine] = json.loads(proc.stdout.strip().splitlines()[-1])
+            results[engine]["output"] = out_path
+
+        reference = results.get("pillow")
+        print(f"{'engine':<8} {'median s':>9} {'min s':>8} {'peak MB':>8} {'extra MB':>9} {'speedup':>8} {'max diff':>9}")
+        for engine, r in results.items():
+            speedup = f"{reference['median_s'] / r['median_s']:.2f}x" if reference else "-"
+            diff = "-"
+            if reference:
+                with Image.open(reference["output"]) as a, Image.open(r["output"]) as b:
+                    diff = max(hi for _, hi in ImageChops.difference(a, b).getextrema())
+            print(f"{engine:<8} {r['median_s']:>9.3f} {r['min_s']:>8.3f} {r['peak_rss_mb']:>8.1f} "
+                  f"{r['extra_rss_mb']:>9.1f} {speedup:>8} {diff:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Load test for /reconstruct against the local stand-in providers.
+
+Starts bench/mock_providers.py and an engine (uvicorn main:app) wired to
+it, then drives POST /reconstruct with a fixed number of concurrent
+clients per level and reports throughput, p50/p95/p99 latency, errors by
+status and where the images came from. "fallback" is the share of
+responses not produced by the first provider in the chain (per the
+X-Reconstruct-Source header); "fallback attempts" is the rise in
+engine_fallbacks_total per request, i.e. how many failed attempts a
+request walked past on average.
+
+    python bench/load_test.py --concurrency 1,8,32 --requests 200
+    python bench/load_test.py --openai latency=1,error=0.2 --hf loading=0.3 --mode hedge
+    python bench/load_test.py --engine-url http://127.0.0.1:8001 --no-mocks
+
+The engine runs with the result cache off, so every request reaches the
+mocks. Use --engine-url to target an already running engine instead.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ENGINE_DIR = os.path.dirname(HERE)
+
+sys.path.insert(0, HERE)
+from mock_providers import DEFAULT_PORTS  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def fragment_jpeg(side=512):
+    im = Image.radial_gradient("L").resize((side, side)).convert("RGB")
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _wait_until_up(url, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_mocks(args):
+    cmd = [sys.executable, os.path.join(HERE, "mock_providers.py"), "--image-side", str(args.image_side)]
+    for name in DEFAULT_PORTS:
+        cmd += [f"--{name}", getattr(args, name), f"--{name}-port", str(args.ports[name])]
+    if args.seed is not None:
+        cmd += ["--seed", str(args.seed)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL if args.quiet else None)
+    for name, port in args.ports.items():
+        _wait_until_up(f"http://127.0.0.1:{port}/stats", proc)
+    return proc
+
+
+def start_engine(args, port):
+    mocks = {name: f"http://127.0.0.1:{p}" for name, p in args.ports.items()}
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "OPENAI_API_KEY": "mock" if "openai" in args.providers else "",
+        "REPLICATE_API_TOKEN": "mock" if "replicate" in args.providers else "",
+        "HF_API_KEY": "mock" if "hf" in args.providers else "",
+        "OPENAI_BASE_URL": mocks["openai"],
+        "REPLICATE_BASE_URL": mocks["replicate"],
+        "HF_BASE_URL": mocks["hf"],
+        "HF_INFERENCE_BASE_URL": mocks["hf"],
+        # Keep .env settings that would change the chain or bypass the mocks out of the run
+        "REPLICATE_MODEL": "",
+        "REPLICATE_MODEL_VERSION": "",
+        "REPLICATE_WEBHOOK_URL": "",
+        "HF_MODEL": "",
+        "RECONSTRUCT_MODE": args.mode,
+        "RECONSTRUCT_CACHE": "false",
+        "RECONSTRUCT_PERSIST": "false",
+        "WARMUP": "false",
+    })
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning", "--no-access-log"]
+    proc = subprocess.Popen(cmd, cwd=ENGINE_DIR, env=env, stdout=subprocess.DEVNULL if args.quiet else None)
+    _wait_until_up(f"http://127.0.0.1:{port}/health", proc)
+    return proc
+
+
+async def scrape_fallbacks(client, engine_url):
+    try:
+        text = (await client.get(f"{engine_url}/metrics")).text
+    except httpx.HTTPError:
+        return None
+    return sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines()
+               if line.startswith("engine_fallbacks_total{"))
+
+
+async def run_level(client, engine_url, concurrency, total, fragment, deadline):
+    """Closed loop: `concurrency` clients share `total` requests."""
+    results = []
+    remaining = iter(range(total))
+
+    async def worker():
+        for i in remaining:
+            data = {"prompt": f"load test request {i}"}
+            if deadline:
+                data["deadline"] = str(deadline)
+            start = time.perf_counter()
+            try:
+                resp = await client.post(f"{engine_url}/reconstruct", data=data,
+                                         files={"files": ("fragment.jpg", fragment, "image/jpeg")})
+                status, source = resp.status_code, resp.headers.get("x-reconstruct-source")
+            except httpx.HTTPError as e:
+                status, source = e.__class__.__name__, None
+            results.append((time.perf_counter() - start, status, source))
+
+    before = await scrape_fallbacks(client, engine_url)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    after = await scrape_fallbacks(client, engine_url)
+    fallback_attempts = (after - before) / total if before is not None and after is not None else None
+    return summarize(concurrency, results, elapsed, fallback_attempts)
+
+
+def summarize(concurrency, results, elapsed, fallback_attempts):
+    ok = [r for r in results if r[1] == 200]
+    latencies = [r[0] for r in ok]
+    sources = {}
+    for _, _, source in ok:
+        provider = (source or "unknown").split(":", 1)[0]
+        sources[provider] = sources.get(provider, 0) + 1
+    errors = {}
+    for _, status, _ in results:
+        if status != 200:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "p50_s": percentile(latencies, 50),
+        "p95_s": percentile(latencies, 95),
+        "p99_s": percentile(latencies, 99),
+        "mean_s": statistics.fmean(latencies) if latencies else float("nan"),
+        "sources": sources,
+        "fallback_attempts": fallback_attempts,
+    }
+
+
+def report_header():
+    print(f"{'conc':>5} {'reqs':>5} {'ok':>5} {'rps':>7} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+          f"{'fallback':>9} {'fb att':>7} {'placeh':>7}  errors / sources")
+
+
+def report(levels, primary):
+    for r in levels:
+        ok = r["ok"] or 1
+        fallback = 1 - r["sources"].get(primary, 0) / ok if r["ok"] else float("nan")
+        placeholder = r["sources"].get("placeholder", 0) / ok if r["ok"] else float("nan")
+        attempts = f"{r['fallback_attempts']:.2f}" if r["fallback_attempts"] is not None else "-"
+        print(f"{r['concurrency']:>5} {r['requests']:>5} {r['ok']:>5} {r['throughput_rps']:>7.2f} "
+              f"{r['p50_s']:>7.3f} {r['p95_s']:>7.3f} {r['p99_s']:>7.3f} {fallback:>8.1%} {attempts:>7} "
+              f"{placeholder:>6.1%}  {r['errors'] or ''} {r['sources']}")
+
+
+async def drive(args, engine_url):
+    fragment = fragment_jpeg()
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 4)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        levels = []
+        if not args.json:
+            report_header()
+        for concurrency in args.concurrency:
+            if args.warmup:
+                await run_level(client, engine_url, min(concurrency, args.warmup), args.warmup, fragment,
+                                args.deadline)
+            levels.append(await run_level(client, engine_url, concurrency, args.requests, fragment, args.deadline))
+            if not args.json:
+                report(levels[-1:], args.primary)
+        return levels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated client counts")
+    parser.add_argument("--requests", type=int, default=100, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=4, help="unmeasured requests before each level")
+    parser.add_argument("--mode", default="sequential", help="RECONSTRUCT_MODE for the engine")
+    parser.add_argument("--providers", default="openai,replicate,hf",
+                        help="providers given credentials (the chain always runs openai, replicate, hf)")
+    parser.add_argument("--deadline", type=float, default=None, help="per-request deadline field")
+    parser.add_argument("--timeout", type=float, default=600.0, help="client timeout per request")
+    for name in DEFAULT_PORTS:
+        parser.add_argument(f"--{name}", default="", metavar="PROFILE",
+                            help=f"{name} mock profile (see mock_providers.py)")
+    parser.add_argument("--image-side", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--engine-url", help="use a running engine instead of starting one")
+    parser.add_argument("--no-mocks", action="store_true", help="do not start the mock providers")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--quiet", action="store_true", help="silence mock and engine output")
+    args = parser.parse_args(argv)
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    args.providers = [p for p in args.providers.split(",") if p]
+    args.primary = next((p for p in DEFAULT_PORTS if p in args.providers), "placeholder")
+    args.ports = {name: free_port() for name in DEFAULT_PORTS}
+
+    procs = []
+    try:
+        if not args.no_mocks:
+            procs.append(start_mocks(args))
+        engine_url = args.engine_url
+        if engine_url is None:
+            port = free_port()
+            procs.append(start_engine(args, port))
+            engine_url = f"http://127.0.0.1:{port}"
+        if not args.json:
+            print(f"engine {engine_url}, mode={args.mode}, providers={','.join(args.providers)}, "
+                  f"{args.requests} requests per level")
+        levels = asyncio.run(drive(args, engine_url.rstrip("/")))
+        if args.json:
+            print(json.dumps(levels, indent=2))
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+if __name__ == "__main__":
+    main()
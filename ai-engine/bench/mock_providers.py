@@ -0,0 +1,260 @@
+"""
+Local stand-ins for the OpenAI, Replicate and Hugging Face router APIs.
+
+Each provider is its own FastAPI app on its own port, so the engine can be
+pointed at them with OPENAI_BASE_URL, REPLICATE_BASE_URL, HF_BASE_URL and
+HF_INFERENCE_BASE_URL. Their behaviour is set per provider with a profile
+of comma-separated key=value pairs:
+
+    latency   mean seconds per generation (Replicate: until the prediction
+              succeeds, observed through polling)
+    jitter    +/- uniform spread around latency, in seconds
+    error     fraction of generations answered with HTTP 500 (Replicate:
+              predictions that end as "failed")
+    loading   fraction answered with 503 "model is loading"
+    tiny      fraction that return an image too small to be valid
+    missing   HF only: fraction of models (by name) that answer 404
+
+    python bench/mock_providers.py --openai latency=2,error=0.1 \\
+        --replicate latency=6,tiny=0.05 --hf latency=3,loading=0.3
+
+Every generated image is the same pre-rendered PNG of --image-side pixels.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import random
+import time
+import uuid
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+DEFAULT_PORTS = {"openai": 9101, "replicate": 9102, "hf": 9103}
+DEFAULT_PROFILE = {"latency": 0.5, "jitter": 0.1, "error": 0.0, "loading": 0.0, "tiny": 0.0, "missing": 0.0}
+PREDICTION_TTL = 600
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGNgYAAAAAMAASsJTYQAAAAASUVORK5CYII=")
+
+
+def parse_profile(text):
+    profile = dict(DEFAULT_PROFILE)
+    for part in (text or "").split(","):
+        if not part.strip():
+            continue
+        key, _, value = part.partition("=")
+        key = key.strip()
+        if key not in DEFAULT_PROFILE:
+            raise ValueError(f"unknown profile key {key!r}; choose from {', '.join(DEFAULT_PROFILE)}")
+        profile[key] = float(value)
+    return profile
+
+
+def render_image(side, seed=0):
+    """A noisy PNG, so its size is close to a real generation's."""
+    rnd = random.Random(seed)
+    noise = Image.frombytes("L", (side, side), rnd.randbytes(side * side))
+    im = Image.merge("RGB", (noise, noise.rotate(90), noise.rotate(180)))
+    buf = io.BytesIO()
+    im.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+class Behaviour:
+    """Draws latency and outcome for one mock provider from its profile."""
+
+    def __init__(self, profile, image, seed=None):
+        self.profile = profile
+        self.image = image
+        self.random = random.Random(seed)
+        self.counters = {"requests": 0, "ok": 0, "error": 0, "loading": 0, "tiny": 0, "missing": 0}
+
+    def latency(self):
+        p = self.profile
+        return max(0.0, p["latency"] + self.random.uniform(-p["jitter"], p["jitter"]))
+
+    def outcome(self):
+        """One of "error", "loading", "tiny" or "ok"."""
+        self.counters["requests"] += 1
+        roll = self.random.random()
+        for name in ("error", "loading", "tiny"):
+            roll -= self.profile[name]
+            if roll < 0:
+                self.counters[name] += 1
+                return name
+        self.counters["ok"] += 1
+        return "ok"
+
+    def is_missing(self, model):
+        # Stable per model name, so a missing model stays missing
+        missing = (zlib.crc32(model.encode()) % 1000) / 1000 < self.profile["missing"]
+        if missing:
+            self.counters["missing"] += 1
+        return missing
+
+    def image_for(self, outcome):
+        return TINY_PNG if outcome == "tiny" else self.image
+
+
+def _error(outcome):
+    if outcome == "loading":
+        return JSONResponse(status_code=503, content={"error": "Model is loading", "estimated_time": 20.0})
+    return JSONResponse(status_code=500, content={"error": "mock internal error"})
+
+
+def openai_app(behaviour):
+    app = FastAPI()
+
+    @app.get("/v1/models")
+    async def models():
+        return {"data": [{"id": "gpt-image-1"}]}
+
+    @app.post("/v1/images/generations")
+    async def generate():
+        outcome = behaviour.outcome()
+        await asyncio.sleep(behaviour.latency())
+        if outcome in ("error", "loading"):
+            return _error(outcome)
+        b64 = base64.b64encode(behaviour.image_for(outcome)).decode()
+        return {"created": int(time.time()), "data": [{"b64_json": b64}]}
+
+    @app.get("/stats")
+    async def stats():
+        return behaviour.counters
+
+    return app
+
+
+def replicate_app(behaviour, base_url):
+    app = FastAPI()
+    # prediction id -> {"created", "ready_at", "outcome", "status"}
+    predictions = {}
+
+    def view(pred_id):
+        pred = predictions[pred_id]
+        status = pred["status"]
+        body = {"id": pred_id, "status": status, "logs": "", "output": None}
+        if status in ("starting", "processing"):
+            remaining = pred["ready_at"] - time.monotonic()
+            if remaining > 0:
+                total = pred["ready_at"] - pred["created"]
+                done = 1 - remaining / total if total else 1
+                body["status"] = pred["status"] = "processing" if done > 0.1 else "starting"
+                body["logs"] = f"{int(done * 100):3d}%|{'#' * int(done * 10):<10}|"
+                return body
+            status = pred["status"] = "failed" if pred["outcome"] == "error" else "succeeded"
+            body["status"] = status
+        if status == "succeeded":
+            body["logs"] = "100%|##########|"
+            body["output"] = [f"{base_url}/files/{pred_id}.png"]
+        elif status == "failed":
+            body["error"] = "mock prediction failure"
+        return body
+
+    @app.get("/v1/models/{owner}/{name}")
+    async def model(owner: str, name: str):
+        return {"owner": owner, "name": name, "default_version": {"id": "mock-version"}}
+
+    @app.post("/v1/predictions")
+    async def create():
+        outcome = behaviour.outcome()
+        if outcome == "loading":
+            return _error(outcome)
+        pred_id = uuid.uuid4().hex
+        now = time.monotonic()
+        # Forget predictions nobody collected (failed, cancelled, abandoned)
+        for stale in [k for k, p in predictions.items() if now - p["created"] > PREDICTION_TTL]:
+            del predictions[stale]
+        predictions[pred_id] = {"created": now, "ready_at": now + behaviour.latency(),
+                                "outcome": outcome, "status": "starting"}
+        return JSONResponse(status_code=201, content=view(pred_id))
+
+    @app.get("/v1/predictions/{pred_id}")
+    async def poll(pred_id: str):
+        if pred_id not in predictions:
+            return JSONResponse(status_code=404, content={"detail": "Not found"})
+        return view(pred_id)
+
+    @app.post("/v1/predictions/{pred_id}/cancel")
+    async def cancel(pred_id: str):
+        if pred_id in predictions and predictions[pred_id]["status"] in ("starting", "processing"):
+            predictions[pred_id]["status"] = "canceled"
+        return view(pred_id) if pred_id in predictions else JSONResponse(status_code=404, content={})
+
+    @app.get("/files/{pred_id}.png")
+    async def output(pred_id: str):
+        pred = predictions.pop(pred_id, None)
+        if pred is None:
+            return JSONResponse(status_code=404, content={"detail": "Not found"})
+        return Response(content=behaviour.image_for(pred["outcome"]), media_type="image/png")
+
+    @app.get("/stats")
+    async def stats():
+        return {**behaviour.counters, "pending": len(predictions)}
+
+    return app
+
+
+def hf_app(behaviour):
+    app = FastAPI()
+
+    @app.post("/models/{model:path}")
+    async def generate(model: str, request: Request):
+        await request.body()
+        if behaviour.is_missing(model):
+            return JSONResponse(status_code=404, content={"error": f"Model {model} does not exist"})
+        outcome = behaviour.outcome()
+        await asyncio.sleep(behaviour.latency())
+        if outcome in ("error", "loading"):
+            return _error(outcome)
+        return Response(content=behaviour.image_for(outcome), media_type="image/png")
+
+    @app.get("/stats")
+    async def stats():
+        return behaviour.counters
+
+    return app
+
+
+def build_apps(profiles, ports, image, host="127.0.0.1", seed=None):
+    """The three mock apps, keyed by provider name."""
+    behaviours = {name: Behaviour(profiles[name], image, seed) for name in DEFAULT_PORTS}
+    return {
+        "openai": openai_app(behaviours["openai"]),
+        "replicate": replicate_app(behaviours["replicate"], f"http://{host}:{ports['replicate']}"),
+        "hf": hf_app(behaviours["hf"]),
+    }
+
+
+async def serve(apps, ports, host="127.0.0.1"):
+    servers = [
+        uvicorn.Server(uvicorn.Config(app, host=host, port=ports[name], log_level="warning", access_log=False))
+        for name, app in apps.items()
+    ]
+    await asyncio.gather(*(server.serve() for server in servers))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    for name, port in DEFAULT_PORTS.items():
+        parser.add_argument(f"--{name}", default="", metavar="PROFILE", help=f"{name} behaviour profile")
+        parser.add_argument(f"--{name}-port", type=int, default=port)
+    parser.add_argument("--image-side", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=None, help="fix the random outcomes")
+    args = parser.parse_args(argv)
+
+    profiles = {name: parse_profile(getattr(args, name)) for name in DEFAULT_PORTS}
+    ports = {name: getattr(args, f"{name}_port") for name in DEFAULT_PORTS}
+    apps = build_apps(profiles, ports, render_image(args.image_side), args.host, args.seed)
+    for name in DEFAULT_PORTS:
+        print(f"mock {name} on http://{args.host}:{ports[name]} {profiles[name]}", flush=True)
+    asyncio.run(serve(apps, ports, args.host))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Content-addressed cache for reconstruction results.
+
+Entries are keyed on a hash of the uploaded fragment bytes, the prompt and
+the provider/model configuration. Lookups go through a small in-memory LRU
+first and then a size-bounded directory on disk; identical requests that are
+in flight at the same time share a single upstream generation.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+
+def make_key(fragment_digests, prompt, provider_config):
+    """Build the cache key from per-fragment digests, prompt and provider config."""
+    h = hashlib.sha256()
+    for d in fragment_digests:
+        h.update(d.encode())
+        h.update(b"\0")
+    h.update(b"\1")
+    h.update((prompt or "").encode())
+    h.update(b"\1")
+    h.update(json.dumps(provider_config, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class ReconstructionCache:
+    def __init__(self, memory_max_bytes=64 * 1024 * 1024, disk_dir=None, disk_max_bytes=512 * 1024 * 1024):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # key -> (bytes, source)
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size, least recently used first
+        self._disk_bytes = 0
+        self._inflight = {}
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "stores": 0, "evictions": 0}
+        if disk_dir:
+            self._scan_disk()
+
+    # -- memory tier -------------------------------------------------------
+
+    def _memory_get(self, key):
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+        return entry
+
+    def _memory_put(self, key, entry):
+        size = len(entry[0])
+        if size > self.memory_max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old[0])
+        self._memory[key] = entry
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted[0])
+
+    # -- disk tier ---------------------------------------------------------
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".bin")
+
+    def _scan_disk(self):
+        entries = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if name.endswith(".bin"):
+                    st = os.stat(os.path.join(root, name))
+                    entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _disk_read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as fh:
+                source = fh.readline().rstrip(b"\n").decode()
+                data = fh.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data, source
+
+    def _disk_write(self, key, entry):
+        data, source = entry
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(source.encode() + b"\n")
+            fh.write(data)
+        os.replace(tmp, path)
+        return os.path.getsize(path)
+
+    def _remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    async def _disk_get(self, key):
+        if not self.disk_dir or key not in self._disk:
+            return None
+        entry = await asyncio.to_thread(self._disk_read, key)
+        if entry is None:
+            self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+        self._disk.move_to_end(key)
+        return entry
+
+    async def _disk_put(self, key, entry):
+        if not self.disk_dir:
+            return
+        try:
+            size = await asyncio.to_thread(self._disk_write, key, entry)
+        except OSError as e:
+            print("Cache disk write failed:", e)
+            return
+        self._disk_bytes += size - self._disk.pop(key, 0)
+        self._disk[key] = size
+        victims = []
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            victim, victim_size = self._disk.popitem(last=False)
+            self._disk_bytes -= victim_size
+            victims.append(victim)
+        if victims:
+            self.counters["evictions"] += len(victims)
+            await asyncio.to_thread(self._remove_files, victims)
+
+    # -- public API --------------------------------------------------------
+
+    async def get(self, key):
+        entry = self._memory_get(key)
+        if entry is not None:
+            self.counters["memory_hits"] += 1
+            return entry
+        entry = await self._disk_get(key)
+        if entry is not None:
+            self.counters["disk_hits"] += 1
+            self._memory_put(key, entry)
+        return entry
+
+    async def put(self, key, entry):
+        self.counters["stores"] += 1
+        self._memory_put(key, entry)
+        await self._disk_put(key, entry)
+
+    async def get_or_create(self, key, factory, private_errors=()):
+        """
+        Return the cached `(bytes, source)` for `key`, or run `factory()` to
+        produce it. Concurrent callers for the same key wait on the first
+        caller's factory instead of starting their own. A factory returning
+        None is not cached.
+
+        `private_errors` are exceptions that concern only the calling request
+        (such as its own deadline running out): like cancellation, they are
+        not shared with waiting callers, one of which takes over instead.
+        """
+        while True:
+            entry = await self.get(key)
+            if entry is not None:
+                return entry
+
+            pending = self._inflight.get(key)
+            if pending is None:
+                break
+            self.counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The caller that owned the generation went away; take over
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            entry = await factory()
+            if entry is not None:
+                await self.put(key, entry)
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except private_errors:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["coalesced"]
+        lookups = hits + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "inflight": len(self._inflight),
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_max_bytes": self.memory_max_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "disk_max_bytes": self.disk_max_bytes if self.disk_dir else 0,
+        }
@@ -0,0 +1,238 @@
+"""
+Local colorization for /colorize, served by a CPU ONNX Runtime model.
+
+The model is a Lab-space colorizer in the style of Zhang et al.: it takes
+the lightness channel at a fixed resolution, shape (N, 1, H, W), and
+predicts the two chroma channels, shape (N, 2, H, W). Only the small
+lightness image goes through the network. The predicted chroma is
+upsampled and recombined with the full-resolution lightness, so detail
+comes from the original.
+
+Sessions are loaded once at startup and shared through a pool. Requests
+arriving within COLORIZE_BATCH_WAIT_MS of each other are stacked into one
+run() call when the model accepts a batch dimension. Normalisation
+defaults can be overridden by a JSON file next to the model
+(<model>.json with l_cent, l_norm and ab_norm). No model ships with the
+repo; the README describes how to export one.
+"""
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), "models")
+DEFAULT_SIZE = 256
+# Input lightness is fed as (L - l_cent) / l_norm, output chroma is scaled by ab_norm
+DEFAULT_NORMALIZATION = {"l_cent": 50.0, "l_norm": 100.0, "ab_norm": 110.0}
+PNG_COMPRESS_LEVEL = 3
+
+# sRGB (D65) <-> XYZ
+_RGB_TO_XYZ = np.array([
+    [0.412453, 0.357580, 0.180423],
+    [0.212671, 0.715160, 0.072169],
+    [0.019334, 0.119193, 0.950227],
+], dtype=np.float32)
+_XYZ_TO_RGB = np.linalg.inv(_RGB_TO_XYZ).astype(np.float32)
+_WHITE = np.array([0.950456, 1.0, 1.088754], dtype=np.float32)
+
+
+class ColorizeError(ValueError):
+    pass
+
+
+class ModelUnavailable(RuntimeError):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# Lab conversion
+# ---------------------------------------------------------------------------
+
+def rgb_to_lightness(rgb):
+    """uint8 RGB (H, W, 3) -> float32 Lab lightness L (H, W); chroma is never needed."""
+    c = rgb.astype(np.float32) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    y = c @ _RGB_TO_XYZ[1]
+    return np.where(y > 0.008856, 116.0 * np.cbrt(y) - 16.0, 903.3 * y)
+
+
+def lab_to_rgb(lab):
+    """float32 Lab (H, W, 3) -> uint8 RGB (H, W, 3)."""
+    fy = (lab[..., 0] + 16.0) / 116.0
+    f = np.stack([fy + lab[..., 1] / 500.0, fy, fy - lab[..., 2] / 200.0], axis=-1)
+    xyz = np.where(f > 0.206893, f ** 3, (f - 16.0 / 116.0) / 7.787) * _WHITE
+    c = np.clip(xyz @ _XYZ_TO_RGB.T, 0.0, 1.0)
+    c = np.where(c > 0.0031308, 1.055 * c ** (1 / 2.4) - 0.055, 12.92 * c)
+    return (c * 255.0 + 0.5).astype(np.uint8)
+
+
+# ---------------------------------------------------------------------------
+# Pre- and post-processing (run in threads; NumPy releases the GIL)
+# ---------------------------------------------------------------------------
+
+def prepare(data, size, norm, max_pixels=None):
+    """
+    Decode `data` and return `(lightness, model_input)`: the full-resolution
+    L channel and the normalised (1, H, W) input at model resolution.
+    """
+    try:
+        im = Image.open(io.BytesIO(data))
+        if max_pixels and im.width * im.height > max_pixels:
+            raise ColorizeError(f"image is {im.width}x{im.height}, over the {max_pixels} pixel limit")
+        im = im.convert("RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ColorizeError(f"could not decode image ({e.__class__.__name__})")
+    lightness = rgb_to_lightness(np.asarray(im))
+    small = rgb_to_lightness(np.asarray(im.resize(size, Image.BICUBIC)))
+    model_input = ((small - norm["l_cent"]) / norm["l_norm"]).astype(np.float32)[np.newaxis]
+    return lightness, model_input
+
+
+def _upsample(channel, size):
+    return np.asarray(Image.fromarray(channel, mode="F").resize(size, Image.BICUBIC))
+
+
+def finish(lightness, ab, norm):
+    """Upsample predicted chroma `ab` (2, h, w) to `lightness` and encode PNG."""
+    height, width = lightness.shape
+    lab = np.empty((height, width, 3), dtype=np.float32)
+    lab[..., 0] = lightness
+    for i in range(2):
+        lab[..., i + 1] = _upsample(np.ascontiguousarray(ab[i], dtype=np.float32) * norm["ab_norm"], (width, height))
+    buf = io.BytesIO()
+    Image.fromarray(lab_to_rgb(lab), "RGB").save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Session pool with micro-batching
+# ---------------------------------------------------------------------------
+
+class Colorizer:
+    def __init__(self, model_path, sessions=2, max_batch=8, batch_wait=0.01):
+        if onnxruntime is None:
+            raise ModelUnavailable("onnxruntime is not installed")
+        if not os.path.isfile(model_path):
+            raise ModelUnavailable(f"model file {model_path} not found")
+        self.model_path = model_path
+        self.sessions = sessions
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.norm = dict(DEFAULT_NORMALIZATION)
+        sidecar = os.path.splitext(model_path)[0] + ".json"
+        if os.path.isfile(sidecar):
+            with open(sidecar) as fh:
+                self.norm.update({k: float(v) for k, v in json.load(fh).items() if k in DEFAULT_NORMALIZATION})
+        self.size = (DEFAULT_SIZE, DEFAULT_SIZE)
+        self.input_name = None
+        self._idle = None
+        self._queue = None
+        self._batcher = None
+        self._running = set()
+        # One thread per session: run() releases the GIL for the whole inference
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=sessions, thread_name_prefix="colorize")
+        self.counters = {"requests": 0, "batches": 0, "images": 0}
+
+    def load(self):
+        """Create the inference sessions (blocking; call once at startup)."""
+        options = onnxruntime.SessionOptions()
+        # Split the cores between sessions so concurrent batches do not oversubscribe
+        options.intra_op_num_threads = max(1, (os.cpu_count() or 1) // self.sessions)
+        options.inter_op_num_threads = 1
+        sessions = [
+            onnxruntime.InferenceSession(self.model_path, sess_options=options, providers=["CPUExecutionProvider"])
+            for _ in range(self.sessions)
+        ]
+        model_input = sessions[0].get_inputs()[0]
+        self.input_name = model_input.name
+        shape = list(model_input.shape)
+        if len(shape) == 4 and isinstance(shape[2], int) and isinstance(shape[3], int):
+            self.size = (shape[3], shape[2])
+        if shape and shape[0] == 1:
+            # Exported with a fixed batch of one; requests still share the session pool
+            self.max_batch = 1
+        return sessions
+
+    async def start(self):
+        sessions = await asyncio.to_thread(self.load)
+        self._idle = asyncio.Queue()
+        for session in sessions:
+            self._idle.put_nowait(session)
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        print(f"Colorizer loaded {os.path.basename(self.model_path)}: {self.sessions} sessions, "
+              f"input {self.size[0]}x{self.size[1]}, batches of up to {self.max_batch}")
+
+    async def stop(self):
+        if self._batcher:
+            self._batcher.cancel()
+            await asyncio.gather(self._batcher, *self._running, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def infer(self, model_input):
+        """Predict chroma (2, h, w) for one normalised (1, h, w) lightness input."""
+        future = asyncio.get_running_loop().create_future()
+        self.counters["requests"] += 1
+        await self._queue.put((model_input, future))
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(x, f) for x, f in batch if not f.done()]
+            if not batch:
+                continue
+            session = await self._idle.get()
+            # Run without waiting so the next batch collects while this one computes
+            task = asyncio.create_task(self._run_batch(session, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, session, batch):
+        try:
+            inputs = np.stack([x for x, _ in batch])
+            outputs = await asyncio.get_running_loop().run_in_executor(
+                self._executor, session.run, None, {self.input_name: inputs})
+            ab = outputs[0]
+            self.counters["batches"] += 1
+            self.counters["images"] += len(batch)
+            for i, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(ab[i])
+        except Exception as e:
+            print("Colorize batch failed:", e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._idle.put_nowait(session)
+
+    def stats(self):
+        return {
+            **self.counters,
+            "model": os.path.basename(self.model_path),
+            "sessions": self.sessions,
+            "idle_sessions": self._idle.qsize() if self._idle else 0,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "max_batch": self.max_batch,
+            "input_size": list(self.size),
+        }
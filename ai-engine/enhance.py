@@ -0,0 +1,218 @@
+"""
+Local image enhancement for /enhance: denoise, upscale and sharpen, plus
+the optional post-processing chain (`postprocess=edges,...`) that
+/reconstruct and /enhance can run on their output, which ends in the
+requested output format and size variants (see formats.py).
+
+Everything here is CPU work on Pillow images and runs in a worker process
+(see main._run_cpu), so the entry point takes and returns bytes and plain
+values that pickle cheaply. No upstream APIs are involved.
+"""
+import io
+import time
+
+from PIL import Image, ImageFilter
+
+import formats
+import postprocess_edges
+
+DEFAULT_DENOISE = 0.5
+DEFAULT_SCALE = 2.0
+DEFAULT_SHARPEN = 120.0
+MAX_SCALE = 4.0
+MAX_SHARPEN = 500.0
+# Output above this many pixels is refused up front
+DEFAULT_MAX_PIXELS = 40_000_000
+
+RESAMPLING = {
+    "lanczos": Image.LANCZOS,
+    "bicubic": Image.BICUBIC,
+    "bilinear": Image.BILINEAR,
+    "nearest": Image.NEAREST,
+}
+
+
+class EnhanceError(ValueError):
+    pass
+
+
+def enhance_params(denoise=None, scale=None, sharpen=None, resample=None):
+    """Validate request parameters and fill in defaults; raises EnhanceError."""
+    denoise = DEFAULT_DENOISE if denoise is None else denoise
+    scale = DEFAULT_SCALE if scale is None else scale
+    sharpen = DEFAULT_SHARPEN if sharpen is None else sharpen
+    resample = (resample or "lanczos").lower()
+    if not 0 <= denoise <= 1:
+        raise EnhanceError("denoise must be between 0 and 1")
+    if not 1 <= scale <= MAX_SCALE:
+        raise EnhanceError(f"scale must be between 1 and {MAX_SCALE:g}")
+    if not 0 <= sharpen <= MAX_SHARPEN:
+        raise EnhanceError(f"sharpen must be between 0 and {MAX_SHARPEN:g} (percent)")
+    if resample not in RESAMPLING:
+        raise EnhanceError(f"resample must be one of {', '.join(RESAMPLING)}")
+    return {"denoise": denoise, "scale": scale, "sharpen": sharpen, "resample": resample}
+
+
+def denoise_image(im, strength):
+    """
+    Blend towards a median-filtered copy: 0 leaves the image untouched, 1 is
+    a full 3x3 median. Above 0.75 a 5x5 median is used for heavier grain.
+    """
+    if strength <= 0:
+        return im
+    smoothed = im.filter(ImageFilter.MedianFilter(5 if strength > 0.75 else 3))
+    if strength >= 1:
+        return smoothed
+    return Image.blend(im, smoothed, strength)
+
+
+def upscale_image(im, scale, resample="lanczos"):
+    if scale == 1:
+        return im
+    size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+    return im.resize(size, RESAMPLING[resample])
+
+
+def sharpen_image(im, percent):
+    """Unsharp mask with the radius and threshold postprocess_edges uses."""
+    if percent <= 0:
+        return im
+    base = postprocess_edges.UNSHARP
+    return im.filter(ImageFilter.UnsharpMask(radius=base.radius, percent=int(percent), threshold=base.threshold))
+
+
+def _edges_stage(im):
+    return postprocess_edges.enhance_image(im)
+
+
+def _denoise_stage(im):
+    return denoise_image(im, DEFAULT_DENOISE)
+
+
+def _sharpen_stage(im):
+    return sharpen_image(im, DEFAULT_SHARPEN)
+
+
+# Post-processing stages by name; each takes and returns a PIL image
+POSTPROCESS_STAGES = {
+    "edges": _edges_stage,
+    "denoise": _denoise_stage,
+    "sharpen": _sharpen_stage,
+}
+
+
+def postprocess_chain(value):
+    """
+    Parse a `postprocess` field ("edges", "denoise,edges", ...) into a tuple
+    of stage names; empty or "none" gives (). Raises EnhanceError.
+    """
+    if not value:
+        return ()
+    names = tuple(n for n in value.replace(" ", ",").lower().split(",") if n)
+    if names == ("none",):
+        return ()
+    unknown = [n for n in names if n not in POSTPROCESS_STAGES]
+    if unknown:
+        raise EnhanceError(f"unknown postprocess stage {unknown[0]!r}; "
+                           f"choose from {', '.join(POSTPROCESS_STAGES)}")
+    return names
+
+
+def _working_mode(im):
+    if im.mode in ("RGB", "RGBA", "L"):
+        return im
+    if "A" in im.getbands() or "transparency" in im.info:
+        return im.convert("RGBA")
+    return im.convert("RGB")
+
+
+class _Laps:
+    """Stage timings for one worker call: `lap(stage)` records time since the last lap."""
+
+    def __init__(self):
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.start
+        self.start = now
+
+
+def _decode(data, scale=1, max_pixels=DEFAULT_MAX_PIXELS):
+    try:
+        im = Image.open(io.BytesIO(data))
+        out_pixels = im.width * scale * im.height * scale
+        if max_pixels and out_pixels > max_pixels:
+            raise EnhanceError(
+                f"output would be {im.width * scale:.0f}x{im.height * scale:.0f}, over the {max_pixels} pixel limit")
+        im = _working_mode(im)
+        im.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise EnhanceError(f"could not decode image ({e.__class__.__name__})")
+    return im
+
+
+def _encode(im, output, original=None):
+    """`{variant: bytes}` for `output` (a formats.output_spec), or a PNG "full"."""
+    if output is None:
+        return {"full": original if original is not None else formats.encode(im, "png")}
+    return formats.render(im, output, original)
+
+
+def _run_chain(im, chain, laps):
+    for name in chain:
+        im = POSTPROCESS_STAGES[name](im)
+        laps.lap(f"postprocess_{name}")
+    return im
+
+
+def enhance_bytes(data, denoise=DEFAULT_DENOISE, scale=DEFAULT_SCALE, sharpen=DEFAULT_SHARPEN,
+                  resample="lanczos", max_pixels=DEFAULT_MAX_PIXELS, postprocess=(), output=None):
+    """
+    Decode `data`, run denoise -> upscale -> sharpen, then any `postprocess`
+    stages, and encode per `output` (PNG by default). Returns `(variants,
+    timings)`: variant name ("full", "thumb_256", ...) to bytes, and stage
+    name to seconds. Raises EnhanceError for undecodable input or oversized
+    output.
+    """
+    laps = _Laps()
+    lap = laps.lap
+    im = _decode(data, scale, max_pixels)
+    lap("decode")
+
+    # Denoise before upscaling: cheaper, and grain is not enlarged first
+    im = denoise_image(im, denoise)
+    lap("denoise")
+    im = upscale_image(im, scale, resample)
+    lap("upscale")
+    im = sharpen_image(im, sharpen)
+    lap("sharpen")
+    # Chained stages reuse the decoded image rather than a second round trip
+    im = _run_chain(im, postprocess, laps)
+
+    variants = _encode(im, output)
+    lap("encode")
+    return variants, laps.timings
+
+
+def finish_bytes(data, chain=(), output=None, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    Run the post-processing `chain` (stage names from postprocess_chain) on
+    encoded image bytes, then encode per `output`, all from one decode.
+    Returns `(variants, timings)` as enhance_bytes does. Callers skip this
+    entirely when there is nothing to do, so the image is never decoded for
+    nothing; with no chain an unchanged "full" keeps the original bytes.
+    """
+    laps = _Laps()
+    im = _decode(data, max_pixels=max_pixels)
+    laps.lap("decode")
+    im = _run_chain(im, chain, laps)
+    variants = _encode(im, output, None if chain else data)
+    laps.lap("encode")
+    return variants, laps.timings
+
+
+def ping():
+    """No-op used to start pool workers ahead of the first request."""
+    return True
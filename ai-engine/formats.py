@@ -0,0 +1,191 @@
+"""
+Output format negotiation, re-encoding and size variants.
+
+Providers return large PNGs (1024x1024 from OpenAI). Responses can instead
+be re-encoded to WebP, AVIF or progressive JPEG, capped to `max_side`, and
+accompanied by thumbnails rendered from the same decoded image. The format
+comes from an explicit `format` field or else the request's Accept header;
+without either the provider's bytes pass through untouched.
+
+AVIF needs a Pillow build with AVIF support (Pillow >= 11.2, or the
+pillow-avif-plugin package); without it AVIF requests fall back to WebP.
+"""
+import io
+
+from PIL import Image
+
+try:
+    import pillow_avif  # noqa: F401  (registers the AVIF codec with older Pillow)
+except ImportError:
+    pass
+
+DEFAULT_QUALITY = 80
+# Formats a request may name, by MIME type
+MEDIA_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+ALIASES = {"jpg": "jpeg"}
+# Tried in order when a format cannot be encoded here
+FALLBACKS = {"avif": "webp", "webp": "jpeg"}
+# Accept-header preference on equal q-values: smallest files first
+PREFERENCE = ("avif", "webp", "jpeg", "png")
+MAX_SIDE = 8192
+# zlib level for PNG output; 6 (Pillow's default) roughly doubles encode
+# time on large upscales for a few percent smaller files
+PNG_COMPRESS_LEVEL = 3
+
+
+class FormatError(ValueError):
+    pass
+
+
+def sniff(data):
+    """The MEDIA_TYPES format of encoded image bytes, from their magic number, or None."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis"):
+        return "avif"
+    return None
+
+
+def passes_through(spec, data):
+    """True when `spec` would leave `data` as it is: same format, no resize, no thumbnails."""
+    return (spec["max_side"] is None and not spec["thumbnails"]
+            and spec["format"] in (None, sniff(data)))
+
+
+def can_encode(fmt):
+    Image.init()
+    return fmt.upper() in Image.SAVE
+
+
+def resolve(fmt):
+    """The format actually used for `fmt`, after falling back for missing codecs."""
+    while not can_encode(fmt):
+        if fmt not in FALLBACKS:
+            raise FormatError(f"{fmt} encoding is not available")
+        fmt = FALLBACKS[fmt]
+    return fmt
+
+
+def parse_format(value):
+    if not value:
+        return None
+    fmt = ALIASES.get(value.strip().lower(), value.strip().lower())
+    if fmt not in MEDIA_TYPES:
+        raise FormatError(f"format must be one of {', '.join(MEDIA_TYPES)}")
+    return fmt
+
+
+def negotiate(accept):
+    """
+    Pick a format from an Accept header. Only explicitly listed image types
+    count: `*/*` and `image/*` (what plain fetches send) keep the original.
+    """
+    if not accept:
+        return None
+    by_type = {media_type: fmt for fmt, media_type in MEDIA_TYPES.items()}
+    by_type["image/jpg"] = "jpeg"
+    offers = []
+    for part in accept.split(","):
+        media_type, _, params = part.strip().partition(";")
+        fmt = by_type.get(media_type.strip().lower())
+        if fmt is None:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0 and can_encode(fmt):
+            offers.append((-q, PREFERENCE.index(fmt), fmt))
+    return min(offers)[2] if offers else None
+
+
+def output_spec(format=None, quality=None, max_side=None, accept=None, thumbnails=(), default=None):
+    """
+    Validate output parameters into a plain dict for the worker, or None
+    when the original bytes can be served as they are. An explicit
+    `format` wins over `accept`, which wins over the `default` format.
+    Raises FormatError.
+    """
+    fmt = parse_format(format) or negotiate(accept) or parse_format(default)
+    if quality is not None and not 1 <= quality <= 100:
+        raise FormatError("quality must be between 1 and 100")
+    if max_side is not None and not 16 <= max_side <= MAX_SIDE:
+        raise FormatError(f"max_side must be between 16 and {MAX_SIDE}")
+    if fmt is None and max_side is None and not thumbnails:
+        return None
+    return {
+        "format": resolve(fmt) if fmt else None,
+        "quality": quality or DEFAULT_QUALITY,
+        "max_side": max_side,
+        "thumbnails": tuple(sorted(set(thumbnails), reverse=True)),
+    }
+
+
+def fit(im, side):
+    """Shrink `im` so its longer side is at most `side` (never enlarges)."""
+    if not side or max(im.size) <= side:
+        return im
+    scale = side / max(im.size)
+    size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+    return im.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def encode(im, fmt, quality=DEFAULT_QUALITY):
+    buf = io.BytesIO()
+    if fmt == "jpeg":
+        if im.mode not in ("RGB", "L"):
+            im = _flatten(im)
+        im.save(buf, format="JPEG", quality=quality, progressive=True, optimize=True)
+    elif fmt == "webp":
+        im.save(buf, format="WEBP", quality=quality, method=4)
+    elif fmt == "avif":
+        im.save(buf, format="AVIF", quality=quality)
+    else:
+        im.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+
+def _flatten(im):
+    """Composite transparency onto white for formats without alpha."""
+    im = im.convert("RGBA")
+    background = Image.new("RGB", im.size, (255, 255, 255))
+    background.paste(im, mask=im.getchannel("A"))
+    return background
+
+
+def render(im, spec, original=None):
+    """
+    Encode `im` according to `spec` and return `{variant: bytes}`: "full"
+    plus "thumb_<side>" for each thumbnail. Without a format a resized
+    "full" is PNG; when `original` bytes are given, the size does not
+    change and the format is unset or already theirs, "full" reuses them
+    unencoded.
+    Thumbnails are cut from the previous, larger size, not the source.
+    """
+    fmt = spec["format"]
+    quality = spec["quality"]
+    full = fit(im, spec["max_side"])
+    if original is not None and full is im and fmt in (None, sniff(original)):
+        variants = {"full": original}
+    else:
+        variants = {"full": encode(full, fmt or "png", quality)}
+    # Thumbnails of a kept original still get a compact format
+    thumb_format = fmt or resolve("webp")
+    smaller = full
+    for side in spec["thumbnails"]:
+        smaller = fit(smaller, side)
+        variants[f"thumb_{side}"] = encode(smaller, thumb_format, quality)
+    return variants
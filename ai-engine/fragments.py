@@ -0,0 +1,261 @@
+"""
+Bounded fragment ingestion and fragment-aware prompting.
+
+Uploads are capped twice: `BodyLimitMiddleware` refuses upload request
+bodies over the total budget before they are parsed (from Content-Length, or while a
+chunked body streams in), and `ingest()` enforces per-file and total caps
+while hashing each spooled upload in chunks. The bytes are never held in
+memory as a whole.
+
+Each fragment is validated from its header alone (format and dimensions),
+then decoded cheaply into a small thumbnail (JPEG draft mode scales during
+the DCT). From the thumbnail come a few compact features: the dominant
+colour palette and the aspect ratio, which `prompt_hint()` turns into a
+sentence for the generation prompt.
+"""
+import asyncio
+import hashlib
+
+from PIL import Image
+
+CHUNK_SIZE = 256 * 1024
+# Formats accepted as fragments (Pillow format names)
+FORMATS = ("JPEG", "PNG", "WEBP", "GIF", "MPO", "TIFF", "BMP")
+THUMBNAIL_SIDE = 128
+PALETTE_COLORS = 5
+# Room for multipart boundaries and form fields on top of the file bytes
+BODY_OVERHEAD = 64 * 1024
+
+# Named reference colours for prompts; models follow names better than hex
+COLOR_NAMES = {
+    "black": (20, 20, 20),
+    "charcoal": (60, 60, 60),
+    "grey": (128, 128, 128),
+    "white": (245, 245, 245),
+    "cream": (238, 224, 192),
+    "beige": (210, 190, 150),
+    "sand": (194, 170, 120),
+    "ochre": (204, 153, 51),
+    "yellow": (230, 200, 60),
+    "terracotta": (190, 95, 55),
+    "rust": (150, 60, 30),
+    "red": (180, 30, 30),
+    "brown": (120, 75, 40),
+    "dark brown": (70, 45, 25),
+    "olive": (110, 110, 50),
+    "green": (60, 130, 70),
+    "turquoise": (60, 170, 170),
+    "blue": (50, 90, 170),
+    "navy": (25, 35, 80),
+}
+
+
+class FragmentError(ValueError):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# Request body limit
+# ---------------------------------------------------------------------------
+
+class BodyLimitMiddleware:
+    """
+    Answer 413 to request bodies on `paths` over `max_bytes()` bytes, up
+    front when Content-Length says so, otherwise as soon as the streamed body
+    passes it. Other paths are left alone.
+    """
+
+    def __init__(self, app, max_bytes, paths):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        limit = self.max_bytes()
+        headers = dict(scope.get("headers") or ())
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            await self._reject(send, limit)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise BodyTooLarge()
+            return message
+
+        async def limited_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                if exceeded:
+                    # The form parser turned our exception into its own error
+                    # response; answer with the limit instead
+                    await self._reject(send, limit)
+                    return
+            if not exceeded:
+                await send(message)
+
+        try:
+            await self.app(scope, limited_receive, limited_send)
+        except BodyTooLarge:
+            if started:
+                raise
+            await self._reject(send, limit)
+
+    @staticmethod
+    async def _reject(send, limit):
+        body = f'{{"detail":"Request body over the {limit} byte upload limit"}}'.encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"connection", b"close"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+# ---------------------------------------------------------------------------
+# Ingestion
+# ---------------------------------------------------------------------------
+
+async def _digest(upload, max_file_bytes):
+    """sha256 hex digest and size of an upload, read in chunks; refuses oversized files."""
+    h = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_file_bytes:
+            raise FragmentError(f"{upload.filename} is over the {max_file_bytes} byte per-file limit", 413)
+        h.update(chunk)
+    await upload.seek(0)
+    return h.hexdigest(), size
+
+
+def inspect(fh, name, max_pixels, side=THUMBNAIL_SIDE):
+    """
+    Validate one fragment from its header and extract its features from a
+    draft-mode thumbnail. Returns a small dict; raises FragmentError.
+    """
+    try:
+        im = Image.open(fh)
+    except Image.DecompressionBombError:
+        raise FragmentError(f"{name} is over the pixel limit", 413)
+    except OSError:
+        raise FragmentError(f"{name} is not a readable image")
+    with im:
+        if im.format not in FORMATS:
+            raise FragmentError(f"{name} is {im.format}; fragments must be one of {', '.join(FORMATS)}")
+        fmt = im.format
+        width, height = im.size
+        if width * height > max_pixels:
+            raise FragmentError(f"{name} is {width}x{height}, over the {max_pixels} pixel limit", 413)
+        try:
+            # JPEG decodes straight to (at least) the thumbnail scale
+            im.draft("RGB", (side, side))
+            im.thumbnail((side, side), reducing_gap=2.0)
+            thumb = im.convert("RGBA")
+        except (OSError, ValueError, SyntaxError) as e:
+            raise FragmentError(f"{name} could not be decoded ({e.__class__.__name__})")
+    return {
+        "width": width,
+        "height": height,
+        "aspect": round(width / height, 3),
+        "format": fmt,
+        "palette": palette(thumb),
+    }
+
+
+def palette(im, colors=PALETTE_COLORS):
+    """Dominant colours of an RGBA image as `[(hex, share), ...]`, transparent pixels ignored."""
+    alpha = im.getchannel("A")
+    quantized = im.convert("RGB").quantize(colors)
+    counts = quantized.histogram(mask=alpha)[:colors]
+    total = sum(counts) or 1
+    rgb = quantized.getpalette()[:colors * 3]
+    found = []
+    for i, n in enumerate(counts):
+        if n:
+            r, g, b = rgb[i * 3:i * 3 + 3]
+            found.append((f"#{r:02x}{g:02x}{b:02x}", round(n / total, 3)))
+    return sorted(found, key=lambda c: -c[1])
+
+
+async def ingest(files, max_files, max_file_bytes, max_total_bytes, max_pixels):
+    """
+    Check, hash and inspect uploaded fragments one at a time. Returns
+    `(digests, features)`; raises FragmentError (413 for size limits).
+    """
+    if len(files) > max_files:
+        raise FragmentError(f"At most {max_files} fragments can be uploaded at once", 413)
+    digests, features = [], []
+    total = 0
+    for upload in files:
+        digest, size = await _digest(upload, max_file_bytes)
+        total += size
+        if total > max_total_bytes:
+            raise FragmentError(f"Fragments total over the {max_total_bytes} byte upload limit", 413)
+        # Pillow reads the spooled file directly: only the header and the
+        # draft-scale thumbnail are ever decoded
+        info = await asyncio.to_thread(inspect, upload.file, upload.filename, max_pixels)
+        digests.append(digest)
+        features.append({"filename": upload.filename, "bytes": size, **info})
+    return digests, features
+
+
+# ---------------------------------------------------------------------------
+# Prompting
+# ---------------------------------------------------------------------------
+
+def color_name(hex_color):
+    r, g, b = (int(hex_color[i:i + 2], 16) for i in (1, 3, 5))
+
+    def distance(ref):
+        # "Redmean" weighting: a cheap approximation of perceptual distance
+        rm = (r + ref[0]) / 2
+        dr, dg, db = r - ref[0], g - ref[1], b - ref[2]
+        return (2 + rm / 256) * dr * dr + 4 * dg * dg + (2 + (255 - rm) / 256) * db * db
+
+    return min(COLOR_NAMES, key=lambda name: distance(COLOR_NAMES[name]))
+
+
+def prompt_hint(features, max_colors=3):
+    """
+    A sentence describing the fragments' colours and proportions, or ""
+    when there is nothing useful to say.
+    """
+    shares = {}
+    for f in features:
+        for hex_color, share in f["palette"]:
+            name = color_name(hex_color)
+            shares[name] = shares.get(name, 0.0) + share / len(features)
+    names = [n for n, share in sorted(shares.items(), key=lambda kv: -kv[1]) if share >= 0.05][:max_colors]
+    parts = []
+    if names:
+        listed = names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+        parts.append(f"The fragments' dominant colours are {listed}; match the body and glaze colours to them.")
+    aspects = sorted(f["aspect"] for f in features)
+    if aspects:
+        median = aspects[len(aspects) // 2]
+        if median < 0.8:
+            parts.append(f"The fragments are taller than wide (aspect ratio about {median:.2f}).")
+        elif median > 1.25:
+            parts.append(f"The fragments are wider than tall (aspect ratio about {median:.2f}).")
+    return " ".join(parts)
@@ -0,0 +1,215 @@
+"""
+In-process job queue for long-running reconstructions.
+
+Jobs are queued on an asyncio queue and executed by a fixed number of worker
+tasks. When `max_queue` jobs are already waiting (cancelled ones do not
+count) `submit()` raises `QueueFull` right away so the HTTP layer can answer
+429 instead of holding the connection open.
+Finished jobs are kept for `ttl` seconds so their result can be fetched,
+but no more than `max_retained` of them and `max_bytes` of results (as
+measured by `sizeof`): beyond either cap the oldest finished jobs are
+dropped first. Retention is enforced whenever a job finishes and
+periodically, so results do not outlive their TTL when traffic stops.
+Every job has a progress log (see progress.py) that is installed while it
+runs, and can be cancelled whether it is still queued or already running.
+"""
+import asyncio
+import time
+import uuid
+
+from progress import Progress, current_progress
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, factory):
+        self.id = uuid.uuid4().hex
+        self.factory = factory
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.result_bytes = 0
+        self.error = None
+        self.error_status = None
+        self.done = asyncio.Event()
+        self.progress = Progress()
+        self.task = None
+        self.cancel_requested = False
+
+    @property
+    def queue_wait(self):
+        if self.started_at is None:
+            # A job cancelled while queued stopped waiting when it finished
+            return (self.finished_at or time.time()) - self.created_at
+        return self.started_at - self.created_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "queue_wait": round(self.queue_wait, 3),
+            "run_time": round(self.run_time, 3) if self.run_time is not None else None,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    def __init__(self, workers=4, max_queue=32, ttl=3600, max_retained=256, max_bytes=None, sizeof=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.max_retained = max_retained
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.jobs = {}
+        # The queue itself is unbounded: admission counts `_pending`, the
+        # queued jobs not yet cancelled, so cancelling frees a slot at once
+        self._queue = asyncio.Queue()
+        self._pending = set()
+        self._tasks = []
+        self._running = 0
+        self._retained_bytes = 0
+        self.counters = {"submitted": 0, "rejected": 0, "succeeded": 0, "failed": 0, "cancelled": 0,
+                         "evicted": 0}
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        self._tasks.append(asyncio.create_task(self._pruner()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, factory):
+        """Queue `factory()` (a coroutine function) and return its Job."""
+        self._prune()
+        if len(self._pending) >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise QueueFull()
+        job = Job(factory)
+        self._queue.put_nowait(job)
+        self._pending.add(job)
+        self.jobs[job.id] = job
+        self.counters["submitted"] += 1
+        job.progress.emit("queued", position=len(self._pending))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job):
+        """
+        Cancel a queued or running job; returns False if it already finished.
+        A running job's task is cancelled, which also abandons its upstream
+        calls (Replicate predictions are cancelled on the way out).
+        """
+        if job.done.is_set():
+            return False
+        job.cancel_requested = True
+        if job.task is not None:
+            job.task.cancel()
+        elif job.status == "queued":
+            # Still in the queue: the worker that dequeues it skips it
+            self._pending.discard(job)
+            self._finish(job, "cancelled", error="cancelled")
+            self.counters["cancelled"] += 1
+        return True
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        job.factory = None
+        job.task = None
+        if job.result is not None and self.sizeof is not None:
+            job.result_bytes = self.sizeof(job.result)
+            self._retained_bytes += job.result_bytes
+        job.progress.emit(status, **({"error": error} if error else {}))
+        job.progress.close()
+        job.done.set()
+        self._prune()
+
+    @staticmethod
+    async def _run(job):
+        # Runs in its own task, so the progress log is only visible to this job
+        current_progress.set(job.progress)
+        return await job.factory()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            self._pending.discard(job)
+            if job.done.is_set():
+                self._queue.task_done()
+                continue
+            job.status = "running"
+            job.started_at = time.time()
+            job.progress.emit("started", queue_wait=round(job.queue_wait, 3))
+            self._running += 1
+            status, error = "failed", None
+            try:
+                job.task = asyncio.create_task(self._run(job))
+                job.result = await job.task
+                status = "succeeded"
+                self.counters["succeeded"] += 1
+            except asyncio.CancelledError:
+                error = "cancelled"
+                if not job.cancel_requested:
+                    raise
+                status = "cancelled"
+                self.counters["cancelled"] += 1
+            except Exception as e:
+                print("Job", job.id, "failed:", e)
+                error = getattr(e, "detail", None) or str(e) or e.__class__.__name__
+                job.error_status = getattr(e, "status_code", 500)
+                self.counters["failed"] += 1
+            finally:
+                self._finish(job, status, error)
+                self._running -= 1
+                self._queue.task_done()
+
+    async def _pruner(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            self._prune()
+
+    def _prune(self):
+        """Drop expired jobs, then the oldest finished ones while over a retention cap."""
+        finished = sorted((j for j in self.jobs.values() if j.finished_at), key=lambda j: j.finished_at)
+        cutoff = time.time() - self.ttl
+        over = len(finished) - self.max_retained if self.max_retained is not None else 0
+        for job in finished:
+            if job.finished_at >= cutoff and over <= 0 and (
+                    self.max_bytes is None or self._retained_bytes <= self.max_bytes):
+                break
+            if job.finished_at >= cutoff:
+                self.counters["evicted"] += 1
+            del self.jobs[job.id]
+            self._retained_bytes -= job.result_bytes
+            over -= 1
+
+    def stats(self):
+        return {
+            **self.counters,
+            "workers": self.workers,
+            "running": self._running,
+            "queued": len(self._pending),
+            "max_queue": self.max_queue,
+            "retained": len(self.jobs),
+            "retained_bytes": self._retained_bytes,
+        }
@@ -1,21 +1,192 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request, Header
 from typing import List
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from dotenv import load_dotenv
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import os
 import io
 import base64
-import requests
-import uvicorn
+import functools
+import hmac
+import json
+import asyncio
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import time
+import uuid
+import uvicorn
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+import colorize
+import enhance
+import formats
+import fragments
+import metrics
+import progress
+import providers
+from cache import ReconstructionCache, make_key
+from jobs import JobQueue, QueueFull
+from routing import router, OPEN, HALF_OPEN
+from settings import SettingsError, load_settings
+
+# Parsed configuration and the attempt plan compiled from it; set on startup
+# and replaced by POST /admin/reload
+settings = None
+attempt_plan = ()
+# Reconstruction result cache, created on startup (None when disabled)
+result_cache = None
+# Background reconstruction jobs, created on startup
+job_queue = None
+# Process pool for local CPU work and the admission limit in front of it,
+# created on startup; the pool is replaced (under the lock) if a worker dies
+cpu_pool = None
+cpu_pool_lock = None
+cpu_slots = None
+# ONNX colorization session pool, loaded on startup (None without a model),
+# and the admission limit on requests colorizing at once
+colorizer = None
+colorize_slots = None
+
+
+def _create_cache(cfg):
+    if not cfg.cache_enabled:
+        return None
+    return ReconstructionCache(
+        memory_max_bytes=cfg.cache_memory_mb * 1024 * 1024,
+        disk_dir=cfg.cache_dir if cfg.cache_disk_mb > 0 else None,
+        disk_max_bytes=cfg.cache_disk_mb * 1024 * 1024,
+    )
+
+
+def _apply_settings(cfg):
+    """Install `cfg` as the active configuration for subsequent requests."""
+    global settings, attempt_plan
+    settings = cfg
+    attempt_plan = _attempt_plan(cfg)
+    providers.configure_concurrency(cfg.provider_concurrency)
+    providers.configure_base_urls(cfg.base_urls)
+
+
+def _credentials(cfg):
+    return {"openai": cfg.openai_api_key, "replicate": cfg.replicate_api_token, "hf": cfg.hf_api_key}
+
+
+async def _warm_up(cfg):
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                providers.warm_up(attempt_plan, _credentials(cfg), hf_models=cfg.warmup_hf_models),
+                asyncio.to_thread(_placeholder_png),
+                _warm_cpu_pool(cfg.cpu_workers),
+            ),
+            timeout=cfg.warmup_timeout or None,
+        )
+    except asyncio.TimeoutError:
+        print("Warm-up did not finish within", cfg.warmup_timeout, "seconds; serving anyway")
+    print(f"Warm-up took {time.monotonic() - start:.1f}s")
+
+
+async def _warm_cpu_pool(workers):
+    # Start every worker process (and its imports) before the first request
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(cpu_pool, enhance.ping) for _ in range(workers)))
+
+
+def _new_cpu_pool(workers):
+    # spawn, not fork: the server process already runs threads (to_thread, httpx)
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def _replace_cpu_pool(broken):
+    """
+    Swap in a fresh pool for `broken` (one whose worker was killed, e.g. by
+    the OOM killer); callers that saw the same breakage share one restart.
+    """
+    global cpu_pool
+    async with cpu_pool_lock:
+        if cpu_pool is not broken:
+            return
+        print("CPU worker pool broke; starting a new one")
+        broken.shutdown(wait=False, cancel_futures=True)
+        cpu_pool = _new_cpu_pool(settings.cpu_workers)
+        metrics.CPU_POOL_RESTARTS.inc()
+
+
+async def _start_colorizer(cfg):
+    path = cfg.colorize_model
+    if not os.path.isabs(path):
+        path = os.path.join(colorize.MODELS_DIR, path)
+    try:
+        model = colorize.Colorizer(path, sessions=cfg.colorize_sessions, max_batch=cfg.colorize_max_batch,
+                                   batch_wait=cfg.colorize_batch_wait_ms / 1000)
+        await model.start()
+    except colorize.ModelUnavailable as e:
+        print("Colorization disabled:", e)
+        return None
+    except Exception as e:
+        print("Colorization model failed to load:", e)
+        return None
+    return model
+
+
+def _job_result_bytes(result):
+    variants, _, _ = result
+    return sum(len(data) for data in variants.values())
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global result_cache, job_queue, cpu_pool, cpu_pool_lock, cpu_slots, colorizer, colorize_slots
+    _apply_settings(load_settings())
+    result_cache = _create_cache(settings)
+    job_queue = JobQueue(workers=settings.job_workers, max_queue=settings.job_queue_max, ttl=settings.job_ttl,
+                         max_retained=settings.job_max_retained,
+                         max_bytes=settings.job_max_retained_mb * 1024 * 1024, sizeof=_job_result_bytes)
+    job_queue.start()
+    cpu_pool = _new_cpu_pool(settings.cpu_workers)
+    cpu_pool_lock = asyncio.Lock()
+    cpu_slots = asyncio.Semaphore(settings.cpu_queue_max)
+    colorizer = await _start_colorizer(settings)
+    colorize_slots = asyncio.Semaphore(settings.colorize_concurrency)
+    # Provider clients live as long as the app so connections are pooled
+    providers.open_clients()
+    if settings.warmup:
+        await _warm_up(settings)
+    try:
+        yield
+    finally:
+        await job_queue.stop()
+        if colorizer is not None:
+            await colorizer.stop()
+        cpu_pool.shutdown(wait=False, cancel_futures=True)
+        await providers.close_clients()
+
 
 app = FastAPI(
     title="Heritage Weaver AI Engine",
     description="AI service for heritage image restoration",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
+def _max_body_bytes():
+    mb = settings.upload_max_total_mb if settings else 50.0
+    return int(mb * 1024 * 1024) + fragments.BODY_OVERHEAD
+
+
+# Inside the metrics middleware, so refused uploads still show up on /metrics.
+# Only fragment uploads are bounded by UPLOAD_MAX_TOTAL_MB.
+app.add_middleware(fragments.BodyLimitMiddleware, max_bytes=_max_body_bytes,
+                   paths=("/reconstruct", "/jobs/reconstruct"))
+app.add_middleware(metrics.MetricsMiddleware)
+
 # CORS middleware for frontend communication
 app.add_middleware(
     CORSMiddleware,
@@ -36,6 +207,102 @@ async def health_check():
     return {"status": "healthy"}
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **result_cache.stats()}
+
+
+def _check_admin(token):
+    # Without ADMIN_TOKEN the admin endpoints are switched off entirely
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((token or "").encode(), settings.admin_token.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/admin/settings")
+async def get_settings(x_admin_token: str = Header(None)):
+    _check_admin(x_admin_token)
+    return settings.summary()
+
+
+@app.post("/admin/reload")
+async def reload_settings(x_admin_token: str = Header(None)):
+    """
+    Re-read the environment/.env file. Provider credentials, models, modes,
+    deadlines and concurrency caps apply to the next request; cache and job
+    pool sizes only take effect on restart. Invalid settings are rejected
+    and the current ones stay active.
+    """
+    _check_admin(x_admin_token)
+    try:
+        cfg = load_settings()
+    except SettingsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _apply_settings(cfg)
+    return {"reloaded": True, "attempts": len(attempt_plan), "settings": cfg.summary()}
+
+
+# Cache, job queue and breaker state are read at scrape time
+metrics.register_collector(
+    "engine_cache_events_total", "Result cache lookups and stores by outcome", "counter",
+    lambda: [({"event": k}, v) for k, v in result_cache.counters.items()] if result_cache else [])
+metrics.register_collector(
+    "engine_cache_bytes", "Bytes held by the result cache per tier", "gauge",
+    lambda: [({"tier": tier}, result_cache.stats()[f"{tier}_bytes"]) for tier in ("memory", "disk")]
+    if result_cache else [])
+metrics.register_collector(
+    "engine_jobs_total", "Reconstruction jobs by outcome", "counter",
+    lambda: [({"outcome": k}, v) for k, v in job_queue.counters.items()] if job_queue else [])
+metrics.register_collector(
+    "engine_jobs", "Reconstruction jobs currently queued or running", "gauge",
+    lambda: [({"state": k}, job_queue.stats()[k]) for k in ("queued", "running")] if job_queue else [])
+metrics.register_collector(
+    "engine_colorize_total", "Colorization requests, model batches and batched images", "counter",
+    lambda: [({"kind": k}, v) for k, v in colorizer.counters.items()] if colorizer else [])
+metrics.register_collector(
+    "engine_circuit_open", "1 when the provider/model circuit breaker is open or half-open", "gauge",
+    lambda: [({"provider": m["provider"], "model": m["model"]}, int(m["state"] in (OPEN, HALF_OPEN)))
+             for m in router.stats()])
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition of engine metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/routing/stats")
+async def routing_stats():
+    """Rolling success rate, latency percentiles and breaker state per provider/model."""
+    return {"models": router.stats()}
+
+
+@app.post("/webhooks/replicate")
+async def replicate_webhook(request: Request):
+    """
+    Receive Replicate prediction completions (enabled by REPLICATE_WEBHOOK_URL).
+    Every delivery must be signed with REPLICATE_WEBHOOK_SECRET; without a
+    secret the endpoint does not exist.
+    """
+    secret = settings.replicate_webhook_secret
+    if not secret:
+        raise HTTPException(status_code=404, detail="Not Found")
+    body = await request.body()
+    if not providers.verify_replicate_webhook(request.headers, body, secret):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    providers.deliver_replicate_webhook(payload)
+    return {"received": True}
+
+
 @app.post("/restore")
 async def restore_image(file: UploadFile = File(...)):
     if not file.content_type.startswith("image/"):
@@ -48,13 +315,22 @@ async def restore_image(file: UploadFile = File(...)):
     )
 
 
-@app.post("/reconstruct")
-async def reconstruct(files: List[UploadFile] = File(...), prompt: str = Form(None)):
+# Build the prompt according to the spec; an incoming `prompt` overrides it
+DEFAULT_PROMPT = (
+    "The uploaded images show broken fragments of a ceramic object. "
+    "Do NOT restore or inpaint the original images. Generate a completely NEW, photorealistic image "
+    "showing how the object most likely looked before it broke. Infer shape, proportions, material, color, and texture. "
+    "Assume symmetry where missing. The object must appear intact, undamaged, and usable. Neutral background. Realistic lighting. "
+    "Explicitly forbid using inpainting, masks, overlays, or U-Net repair in the generation process."
+)
+
+
+async def _prepare_reconstruction(files, prompt, mode, persist, deadline, postprocess=None, output=None):
     """
-    Accept multiple uploaded fragment images and generate a brand-new
-    photorealistic reconstruction image (text-to-image) based on them.
-    The logic uses OPENAI_API_KEY (preferred) or HF_API_KEY as a fallback.
-    The output image is written to `reconstructed_pot.png` inside ai-engine/.
+    Validate a reconstruction request and reduce it to the plain values the
+    generation needs, so it can run after the upload has been closed.
+    Fragments are hashed and inspected one by one within the UPLOAD_* caps;
+    with FRAGMENT_HINTS their colours and proportions extend the prompt.
     """
     if not files:
         raise HTTPException(status_code=400, detail="No files uploaded")
@@ -63,349 +339,365 @@ async def reconstruct(files: List[UploadFile] = File(...), prompt: str = Form(No
         if not f.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail=f"File {f.filename} is not an image")
 
-    load_dotenv()
-    OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-    HF_KEY = os.getenv("HF_API_KEY")
-
-    # Build the prompt according to the spec; allow an incoming `prompt` to override
-    default_prompt = (
-        "The uploaded images show broken fragments of a ceramic object. "
-        "Do NOT restore or inpaint the original images. Generate a completely NEW, photorealistic image "
-        "showing how the object most likely looked before it broke. Infer shape, proportions, material, color, and texture. "
-        "Assume symmetry where missing. The object must appear intact, undamaged, and usable. Neutral background. Realistic lighting. "
-        "Explicitly forbid using inpainting, masks, overlays, or U-Net repair in the generation process."
+    mb = 1024 * 1024
+    try:
+        with metrics.stage("upload_read"):
+            digests, features = await fragments.ingest(
+                files, settings.upload_max_files, int(settings.upload_max_file_mb * mb),
+                int(settings.upload_max_total_mb * mb), settings.fragment_max_pixels)
+    except fragments.FragmentError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    prompt = prompt or DEFAULT_PROMPT
+    if settings.fragment_hints:
+        hint = fragments.prompt_hint(features)
+        if hint:
+            prompt = f"{prompt} {hint}"
+
+    if persist is None:
+        persist = settings.persist
+
+    # Execution mode: request field wins over RECONSTRUCT_MODE
+    mode = (mode or settings.reconstruct_mode).lower()
+    if mode not in providers.EXECUTION_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(providers.EXECUTION_MODES)}")
+
+    # Overall time budget: request field wins over RECONSTRUCT_DEADLINE (0 = none)
+    if deadline is not None and deadline <= 0:
+        raise HTTPException(status_code=400, detail="deadline must be a positive number of seconds")
+    deadline = providers.Deadline(deadline or settings.deadline or None)
+
+    try:
+        chain = enhance.postprocess_chain(postprocess)
+    except enhance.EnhanceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"digests": digests, "fragments": features, "prompt": prompt, "mode": mode, "persist": persist,
+            "deadline": deadline, "postprocess": chain, "output": output}
+
+
+# Hugging Face models tried through the router (HF_MODEL, if set, goes first)
+HF_CANDIDATES = [
+    "stabilityai/stable-diffusion-xl-base-1.0",
+    "stabilityai/stable-diffusion-3.5-large",
+    "stabilityai/stable-diffusion-3-medium",
+    "stabilityai/stable-diffusion-3.5-medium",
+    "stabilityai/stable-diffusion-2-1",
+]
+# Further HF models tried once each after everything else has failed
+HF_FALLBACK_CANDIDATES = [
+    "stabilityai/stable-diffusion-3.5-large",
+    "stabilityai/stable-diffusion-3-medium",
+    "stabilityai/stable-diffusion-3.5-medium",
+    "stabilityai/stable-diffusion-xl-base-1.0",
+    "stable-diffusion-v1-5/stable-diffusion-v1-5",
+    "CompVis/stable-diffusion-v1-4",
+    "Lykon/dreamshaper-8",
+    "stabilityai/stable-diffusion-2-1",
+    "stabilityai/stable-diffusion-2",
+]
+
+
+def _attempt_plan(cfg):
+    """
+    The configured provider chain (OpenAI, Replicate, HF router models,
+    Replicate again, remaining HF models), compiled into a de-duplicated
+    attempt plan by providers.compile_plan.
+    """
+    entries = []
+    if cfg.openai_api_key:
+        entries.append(("openai", "gpt-image-1", ()))
+
+    # Replicate (prefer higher-quality hosted models); tried again after HF
+    # only when a model is explicitly configured.
+    replicate_options = (
+        ("version", cfg.replicate_model_version),
+        # Public URL of /webhooks/replicate; when set completions are pushed, not polled
+        ("webhook_url", cfg.replicate_webhook_url),
     )
-    if not prompt:
-        prompt = default_prompt
+    if cfg.replicate_api_token:
+        model_slug = cfg.replicate_model or "stability-ai/stable-diffusion-xl"
+        entries.append(("replicate", model_slug, replicate_options + (("max_wait", 120),)))
 
-    output_path = os.path.join(os.path.dirname(__file__), "reconstructed_pot.png")
+    if cfg.hf_api_key:
+        hf_candidates = [cfg.hf_model] if cfg.hf_model else []
+        for hf_model in hf_candidates + HF_CANDIDATES:
+            entries.append(("hf", hf_model, (("attempts", 3), ("timeout", 180))))
 
-    # Try OpenAI Images API first if key present
-    if OPENAI_KEY:
-        try:
-            headers = {"Authorization": f"Bearer {OPENAI_KEY}", "Content-Type": "application/json"}
-            data = {
-                "model": "gpt-image-1",
-                "prompt": prompt,
-                "size": "1024x1024",
-                "n": 1
-            }
-            resp = requests.post("https://api.openai.com/v1/images/generations", json=data, headers=headers, timeout=60)
-            if resp.status_code != 200:
-                try:
-                    print("OpenAI error:", resp.status_code, resp.text)
-                except Exception:
-                    print("OpenAI error status:", resp.status_code)
-                resp.raise_for_status()
-
-            j = resp.json()
-            if isinstance(j, dict) and "data" in j and len(j["data"]) > 0:
-                item = j["data"][0]
-                if isinstance(item, dict) and "b64_json" in item:
-                    b64 = item["b64_json"]
-                    img_bytes = base64.b64decode(b64)
-                    if len(img_bytes) >= 2000:
-                        with open(output_path, "wb") as out:
-                            out.write(img_bytes)
-                        return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-                elif isinstance(item, dict) and "url" in item:
-                    url = item["url"]
-                    r2 = requests.get(url, timeout=30)
-                    r2.raise_for_status()
-                    if len(r2.content) >= 2000:
-                        with open(output_path, "wb") as out:
-                            out.write(r2.content)
-                        return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-            else:
-                print("Unexpected OpenAI image response format", j)
-        except Exception as e:
-            print("OpenAI generation failed:", e)
-
-    # Try Replicate first if token is available (prefer higher-quality hosted models)
-    REPLICATE_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-    REPLICATE_MODEL = os.getenv("REPLICATE_MODEL") or "stability-ai/stable-diffusion-xl"
-    if REPLICATE_TOKEN:
-        try:
-            headers = {"Authorization": f"Token {REPLICATE_TOKEN}", "Content-Type": "application/json"}
-            model_slug = REPLICATE_MODEL
-            version_id = os.getenv("REPLICATE_MODEL_VERSION")
-            if not version_id:
-                meta_url = f"https://api.replicate.com/v1/models/{model_slug}"
-                mresp = requests.get(meta_url, headers=headers, timeout=30)
-                if mresp.status_code == 200:
-                    mjson = mresp.json()
-                    version_id = mjson.get("default_version", {}).get("id")
-                else:
-                    print("Replicate model meta fetch failed:", mresp.status_code, mresp.text)
-
-            if version_id:
-                payload = {"version": version_id, "input": {"prompt": prompt}}
-                pr = requests.post("https://api.replicate.com/v1/predictions", json=payload, headers=headers, timeout=30)
-                if pr.status_code not in (200, 201):
-                    print("Replicate create prediction failed:", pr.status_code, pr.text)
-                else:
-                    pjson = pr.json()
-                    pred_id = pjson.get("id")
-                    poll_url = f"https://api.replicate.com/v1/predictions/{pred_id}"
-                    for _ in range(120):
-                        time.sleep(1)
-                        prow = requests.get(poll_url, headers=headers, timeout=30)
-                        if prow.status_code != 200:
-                            print("Replicate poll error:", prow.status_code, prow.text)
-                            break
-                        pj = prow.json()
-                        status = pj.get("status")
-                        if status == "succeeded":
-                            output_urls = pj.get("output") or pj.get("result") or []
-                            if isinstance(output_urls, list) and len(output_urls) > 0:
-                                out_url = output_urls[0]
-                                try:
-                                    rimg = requests.get(out_url, timeout=60)
-                                    rimg.raise_for_status()
-                                    if len(rimg.content) >= 2000:
-                                        with open(output_path, "wb") as out:
-                                            out.write(rimg.content)
-                                        print("Replicate model succeeded", model_slug)
-                                        return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-                                    else:
-                                        print("Replicate returned tiny image")
-                                except Exception as e:
-                                    print("Failed to download Replicate output:", e)
-                                    break
-                            else:
-                                print("Replicate succeeded but no output found", pj)
-                                break
-                        elif status in ("failed", "canceled"):
-                            print("Replicate prediction status:", status, pj)
-                            break
-                    else:
-                        print("Replicate prediction timed out")
-        except Exception as e:
-            print("Replicate generation failed:", e)
-
-    # Prefer Hugging Face Inference (router) first if a key is configured.
-    if HF_KEY:
-        hf_headers = {"Authorization": f"Bearer {HF_KEY}", "Accept": "application/octet-stream"}
-        hf_payload = {"inputs": prompt or "A photorealistic intact ceramic pot.", "options": {"wait_for_model": True}}
-
-        # Allow override via env var HF_MODEL, otherwise try these candidates
-        hf_candidates = []
-        if os.getenv("HF_MODEL"):
-            hf_candidates.append(os.getenv("HF_MODEL"))
-        hf_candidates += [
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            "stabilityai/stable-diffusion-3.5-large",
-            "stabilityai/stable-diffusion-3-medium",
-            "stabilityai/stable-diffusion-3.5-medium",
-            "stabilityai/stable-diffusion-2-1",
+    if cfg.replicate_api_token and cfg.replicate_model:
+        entries.append(("replicate", cfg.replicate_model, replicate_options + (("max_wait", 60),)))
+
+    if cfg.hf_api_key:
+        for hf_model in HF_FALLBACK_CANDIDATES:
+            entries.append(("hf", hf_model, (("attempts", 1), ("timeout", 120))))
+
+    return providers.compile_plan(tuple(entries))
+
+
+async def _run_reconstruction(digests, prompt, mode, deadline):
+    """
+    Run the attempt plan (through the cache) and return `(image_bytes, source)`.
+    Raises a 504 once `deadline` (a providers.Deadline) is spent.
+    """
+    plan = attempt_plan
+    credentials = _credentials(settings)
+    hedge_delay = settings.hedge_delay
+
+    async def generate():
+        steps = [
+            (attempt.provider, functools.partial(providers.run_attempt, attempt, credentials, prompt))
+            for attempt in providers.order_plan(plan)
         ]
+        return await providers.run_chain(steps, mode=mode, hedge_delay=hedge_delay)
+
+    async def generate_cached():
+        if result_cache is None or not plan:
+            return await generate()
+        # Identical fragments + prompt + provider setup reuse (or join) one generation
+        provider_config = [[a.provider, a.model, a.options.get("version")] for a in plan]
+        key = make_key(digests, prompt, provider_config)
+        # Our deadline running out should not fail callers with time left
+        return await result_cache.get_or_create(key, generate, private_errors=(providers.DeadlineExceeded,))
+
+    token = providers.current_deadline.set(deadline)
+    try:
+        # wait_for is the backstop: no await inside the chain can outlive the budget
+        result = await asyncio.wait_for(generate_cached(), timeout=deadline.remaining())
+    except (providers.DeadlineExceeded, asyncio.TimeoutError):
+        raise HTTPException(
+            status_code=504,
+            detail=f"Reconstruction deadline of {deadline.seconds:g}s exceeded before any provider produced an image",
+        )
+    finally:
+        providers.current_deadline.reset(token)
+
+    if result:
+        img_bytes, source = result
+        print("Reconstruction produced by", source)
+        metrics.RECONSTRUCTIONS.inc(provider=source.split(":", 1)[0])
+    else:
+        with metrics.stage("placeholder"):
+            img_bytes, source = _placeholder_png(), "placeholder"
+        metrics.PLACEHOLDERS.inc()
+    progress.emit("generated", source=source, bytes=len(img_bytes))
+    return img_bytes, source
+
+
+def _output_spec(accept=None, format=None, quality=None, max_side=None, thumbnails=()):
+    """
+    Resolve output format and size from request fields, the Accept header
+    and the OUTPUT_* settings; None means serve the bytes as they are.
+    """
+    default = None if settings.output_format == "original" else settings.output_format
+    try:
+        # Explicit values (including 0) are validated, not replaced by defaults
+        return formats.output_spec(
+            format, settings.output_quality if quality is None else quality,
+            (settings.output_max_side or None) if max_side is None else max_side,
+            accept, thumbnails, default)
+    except formats.FormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Try models with retries and backoff, prefer api-inference endpoint
-        for hf_model in hf_candidates:
-            hf_model = hf_model.strip()
-            attempts = 3
-            for attempt in range(1, attempts + 1):
-                try:
-                    # Prefer the HF router endpoint which replaces the legacy api-inference
-                    hf_url = f"https://router.huggingface.co/models/{hf_model}"
-                    print(f"Attempt {attempt} calling HF model {hf_model} via HF router")
-                    hf_resp = requests.post(hf_url, json=hf_payload, headers=hf_headers, timeout=180)
-
-                    if hf_resp.status_code == 503:
-                        # Model loading or busy; wait and retry
-                        print("Model loading/busy, retrying after backoff")
-                        time.sleep(5 * attempt)
-                        continue
-
-                    if hf_resp.status_code != 200:
-                        try:
-                            print("HF error response for", hf_model, hf_resp.status_code, hf_resp.text[:400])
-                        except Exception:
-                            print("HF error status for", hf_model, hf_resp.status_code)
-                        break
-
-                    ct = hf_resp.headers.get("content-type", "")
-                    # If we got JSON, try to extract base64 images
-                    if "application/json" in ct:
-                        j = hf_resp.json()
-                        if isinstance(j, dict) and "images" in j and len(j["images"]) > 0:
-                            b64 = j["images"][0]
-                            img_bytes = base64.b64decode(b64)
-                            if len(img_bytes) < 2000:
-                                print("HF returned tiny image, retrying model/attempt")
-                                time.sleep(1)
-                                continue
-                            with open(output_path, "wb") as out:
-                                out.write(img_bytes)
-                            print("HF model produced image (base64)", hf_model)
-                            return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-                        else:
-                            # Search values for base64-like strings
-                            found = False
-                            for v in (j.values() if isinstance(j, dict) else []):
-                                if isinstance(v, str) and v.startswith("iVBOR"):
-                                    img_bytes = base64.b64decode(v)
-                                    if len(img_bytes) < 2000:
-                                        continue
-                                    with open(output_path, "wb") as out:
-                                        out.write(img_bytes)
-                                    found = True
-                                    break
-                            if found:
-                                print("HF model produced image (embedded base64)", hf_model)
-                                return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-                            print("HF JSON response unexpected; trying next model")
-                            break
-                    else:
-                        content = hf_resp.content
-                        if not content or len(content) < 2000:
-                            print("HF returned tiny/bad binary for", hf_model)
-                            break
-                        with open(output_path, "wb") as out:
-                            out.write(content)
-                        print("HF model produced binary image", hf_model)
-                        return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-
-                except Exception as e:
-                    print(f"HF attempt {attempt} for {hf_model} failed:", e)
-                    time.sleep(2 * attempt)
-                    continue
-        print("All HF models/trials exhausted or returned invalid outputs")
-
-    # Try Replicate as a provider (preferred fallback to Hugging Face)
-    REPLICATE_TOKEN = os.getenv("REPLICATE_API_TOKEN")
-    REPLICATE_MODEL = os.getenv("REPLICATE_MODEL")
-    if REPLICATE_TOKEN and REPLICATE_MODEL:
+
+async def _finish_output(img_bytes, source, chain, output, wait=False):
+    """
+    Run the requested post-processing chain on a generated image and encode
+    it per `output`, in one pass in the CPU pool. Returns `{variant: bytes}`
+    ("full" plus any thumbnails). Nothing is decoded when there is nothing
+    to do; the placeholder is re-encoded but never post-processed.
+    """
+    if source == "placeholder":
+        chain = ()
+    if not chain and (output is None or formats.passes_through(output, img_bytes)):
+        return {"full": img_bytes}
+    progress.emit("processing", postprocess=list(chain), format=output and output["format"])
+    start = time.perf_counter()
+    try:
+        variants, timings = await _run_cpu(
+            "finish", enhance.finish_bytes, img_bytes, chain, output, settings.enhance_max_pixels, wait=wait)
+    except enhance.EnhanceError as e:
+        raise HTTPException(status_code=502, detail=f"Could not process the {source} output: {e}")
+    metrics.observe_stage("cpu_wait", max(0.0, time.perf_counter() - start - sum(timings.values())))
+    for stage, seconds in timings.items():
+        metrics.observe_stage(stage if stage.startswith("postprocess_") else f"output_{stage}", seconds)
+    return variants
+
+
+@app.post("/reconstruct")
+async def reconstruct(files: List[UploadFile] = File(...), prompt: str = Form(None), mode: str = Form(None),
+                      persist: bool = Form(None), deadline: float = Form(None), postprocess: str = Form(None),
+                      format: str = Form(None), quality: int = Form(None), max_side: int = Form(None),
+                      accept: str = Header(None)):
+    """
+    Accept multiple uploaded fragment images and generate a brand-new
+    photorealistic reconstruction image (text-to-image) based on them.
+    The logic uses OPENAI_API_KEY (preferred) or HF_API_KEY as a fallback.
+    `mode` (or RECONSTRUCT_MODE) selects how providers are executed:
+    `sequential` (default), `race` or `hedge` (see providers.run_chain).
+    Provider results are cached by fragment bytes, prompt and provider setup.
+    The image is returned from memory; with `persist` (or RECONSTRUCT_PERSIST)
+    a uniquely named copy is also saved under RECONSTRUCT_OUTPUT_DIR.
+    `deadline` (or RECONSTRUCT_DEADLINE) caps the whole request in seconds;
+    every upstream timeout and backoff is cut to the remaining budget and a
+    504 is returned when it runs out.
+    `postprocess` names stages run on the generated image before it is
+    returned or saved, e.g. `edges` (postprocess_edges) or `denoise,edges`;
+    see enhance.POSTPROCESS_STAGES.
+    `format` (avif, webp, jpeg or png; otherwise negotiated from Accept,
+    then OUTPUT_FORMAT), `quality` (1-100) and `max_side` re-encode the
+    result; persisted copies also get THUMBNAIL_SIDES thumbnails.
+    """
+    with metrics.request_timer("reconstruct"), metrics.RECONSTRUCT_IN_FLIGHT.track():
+        persist = settings.persist if persist is None else persist
+        output = _output_spec(accept, format, quality, max_side, settings.thumbnail_sides if persist else ())
+        spec = await _prepare_reconstruction(files, prompt, mode, persist, deadline, postprocess, output)
+        img_bytes, source = await _run_reconstruction(spec["digests"], spec["prompt"], spec["mode"], spec["deadline"])
+        variants = await _finish_output(img_bytes, source, spec["postprocess"], spec["output"])
+        saved_name = await _persist_output(variants) if spec["persist"] else None
+        return _image_response(variants["full"], source, saved_name, vary_accept=True)
+
+
+@app.post("/jobs/reconstruct", status_code=202)
+async def submit_reconstruct_job(files: List[UploadFile] = File(...), prompt: str = Form(None), mode: str = Form(None),
+                                 persist: bool = Form(None), deadline: float = Form(None),
+                                 postprocess: str = Form(None), format: str = Form(None),
+                                 quality: int = Form(None), max_side: int = Form(None),
+                                 accept: str = Header(None)):
+    """
+    Queue a reconstruction and return its job id immediately. Poll
+    GET /jobs/{job_id} for status and fetch GET /jobs/{job_id}/result
+    (optionally with `?wait=<seconds>`) for the image. Answers 429 when the
+    worker pool's queue is full. The `deadline` budget starts counting at
+    submission, so it includes time spent queued. Output fields work as on
+    /reconstruct; THUMBNAIL_SIDES thumbnails are kept with the result and
+    served by GET /jobs/{job_id}/result?variant=thumb_<side>.
+    """
+    output = _output_spec(accept, format, quality, max_side, settings.thumbnail_sides)
+    spec = await _prepare_reconstruction(files, prompt, mode, persist, deadline, postprocess, output)
+
+    async def run():
+        with metrics.request_timer("reconstruct_job"), metrics.RECONSTRUCT_IN_FLIGHT.track():
+            img_bytes, source = await _run_reconstruction(
+                spec["digests"], spec["prompt"], spec["mode"], spec["deadline"])
+            # Jobs are already bounded by the queue, so wait for a CPU slot rather than fail
+            variants = await _finish_output(img_bytes, source, spec["postprocess"], spec["output"], wait=True)
+            saved_name = await _persist_output(variants) if spec["persist"] else None
+        progress.emit("output", source=source, variants={name: len(data) for name, data in variants.items()})
+        return variants, source, saved_name
+
+    try:
+        job = job_queue.submit(run)
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Reconstruction queue is full, retry later",
+                            headers={"Retry-After": "5"})
+    return {
+        **job.to_dict(),
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+        "events_url": f"/jobs/{job.id}/events",
+        "fragments": spec["fragments"],
+    }
+
+
+@app.get("/jobs")
+async def jobs_stats():
+    return job_queue.stats()
+
+
+def _get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = _get_job(job_id)
+    info = job.to_dict()
+    if job.status == "succeeded":
+        variants, info["source"], _ = job.result
+        info["variants"] = {name: f"/jobs/{job.id}/result?variant={name}" for name in variants}
+    return info
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, wait: float = 0, variant: str = "full"):
+    """
+    Return the job's image, waiting up to `wait` seconds (max 300) for it.
+    `variant` picks a thumbnail ("thumb_256", ...) instead of the full image.
+    """
+    job = _get_job(job_id)
+    if wait > 0 and not job.done.is_set():
         try:
-            headers = {"Authorization": f"Token {REPLICATE_TOKEN}", "Content-Type": "application/json"}
-
-            # If a specific model version isn't provided, fetch the model to get its default_version.id
-            model_slug = REPLICATE_MODEL
-            version_id = os.getenv("REPLICATE_MODEL_VERSION")
-            if not version_id:
-                meta_url = f"https://api.replicate.com/v1/models/{model_slug}"
-                mresp = requests.get(meta_url, headers=headers, timeout=30)
-                if mresp.status_code == 200:
-                    mjson = mresp.json()
-                    version_id = mjson.get("default_version", {}).get("id")
-                else:
-                    print("Replicate model meta fetch failed:", mresp.status_code, mresp.text)
-
-            if version_id:
-                payload = {"version": version_id, "input": {"prompt": prompt}}
-                pr = requests.post("https://api.replicate.com/v1/predictions", json=payload, headers=headers, timeout=30)
-                if pr.status_code not in (200, 201):
-                    print("Replicate create prediction failed:", pr.status_code, pr.text)
-                else:
-                    pjson = pr.json()
-                    pred_id = pjson.get("id")
-                    # Poll for completion
-                    poll_url = f"https://api.replicate.com/v1/predictions/{pred_id}"
-                    for _ in range(60):
-                        time.sleep(1)
-                        prow = requests.get(poll_url, headers=headers, timeout=30)
-                        if prow.status_code != 200:
-                            print("Replicate poll error:", prow.status_code, prow.text)
-                            break
-                        pj = prow.json()
-                        status = pj.get("status")
-                        if status == "succeeded":
-                            output_urls = pj.get("output") or pj.get("result") or []
-                            if isinstance(output_urls, list) and len(output_urls) > 0:
-                                # Download first output (could be URL string)
-                                out_url = output_urls[0]
-                                try:
-                                    rimg = requests.get(out_url, timeout=60)
-                                    rimg.raise_for_status()
-                                    with open(output_path, "wb") as out:
-                                        out.write(rimg.content)
-                                    print("Replicate model succeeded", model_slug)
-                                    return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-                                except Exception as e:
-                                    print("Failed to download Replicate output:", e)
-                                    break
-                            else:
-                                print("Replicate succeeded but no output found", pj)
-                                break
-                        elif status in ("failed", "canceled"):
-                            print("Replicate prediction status:", status, pj)
-                            break
-                    else:
-                        print("Replicate prediction timed out")
-        except Exception as e:
-            print("Replicate generation failed:", e)
-
-    # Hugging Face Inference API fallback: try multiple router models and pick the first that returns an image
-    if HF_KEY:
-        hf_headers = {"Authorization": f"Bearer {HF_KEY}", "Accept": "application/octet-stream"}
-        payload = {"inputs": prompt, "options": {"wait_for_model": True}}
-        candidates = [
-            "stabilityai/stable-diffusion-3.5-large",
-            "stabilityai/stable-diffusion-3-medium",
-            "stabilityai/stable-diffusion-3.5-medium",
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            "stable-diffusion-v1-5/stable-diffusion-v1-5",
-            "CompVis/stable-diffusion-v1-4",
-            "Lykon/dreamshaper-8",
-            "stabilityai/stable-diffusion-2-1",
-            "stabilityai/stable-diffusion-2",
-        ]
-        for hf_model in candidates:
-            try:
-                # Try router endpoint first
-                hf_url = f"https://router.huggingface.co/models/{hf_model}"
-                print("Trying HF router model:", hf_model)
-                hf_resp = requests.post(hf_url, json=payload, headers=hf_headers, timeout=120)
-                if hf_resp.status_code == 404:
-                    # If router doesn't have the model, try legacy inference endpoint
-                    try:
-                        print("Router returned 404, trying api-inference for", hf_model)
-                        hf_url2 = f"https://api-inference.huggingface.co/models/{hf_model}"
-                        hf_resp = requests.post(hf_url2, json=payload, headers=hf_headers, timeout=120)
-                    except Exception as e:
-                        print("api-inference attempt failed for", hf_model, e)
-                        continue
-                if hf_resp.status_code != 200:
-                    try:
-                        print("HF error response for", hf_model, hf_resp.status_code, hf_resp.text)
-                    except Exception:
-                        print("HF error status for", hf_model, hf_resp.status_code)
-                    continue
-
-                ct = hf_resp.headers.get("content-type", "")
-                if "application/json" in ct:
-                    j = hf_resp.json()
-                    if isinstance(j, dict) and "images" in j and len(j["images"]) > 0:
-                        b64 = j["images"][0]
-                        img_bytes = base64.b64decode(b64)
-                        with open(output_path, "wb") as out:
-                            out.write(img_bytes)
-                    else:
-                        found = False
-                        for v in j.values():
-                            if isinstance(v, str) and v.startswith("iVBOR"):
-                                img_bytes = base64.b64decode(v)
-                                with open(output_path, "wb") as out:
-                                    out.write(img_bytes)
-                                found = True
-                                break
-                        if not found:
-                            print("HF JSON response unexpected for", hf_model)
-                            continue
-                else:
-                    with open(output_path, "wb") as out:
-                        out.write(hf_resp.content)
-
-                print("HF model succeeded:", hf_model)
-                return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-            except Exception as e:
-                print(f"HF generation with {hf_model} failed:", e)
-
-    # As a final fallback (for testing), create a visible placeholder PNG so
-    # the pipeline returns a usable image instead of a tiny 1x1 pixel file.
-    # Prefer Pillow if available; otherwise fall back to a small embedded PNG.
+            await asyncio.wait_for(job.done.wait(), timeout=min(wait, 300))
+        except asyncio.TimeoutError:
+            pass
+    if job.status == "succeeded":
+        variants, source, saved_name = job.result
+        if variant not in variants:
+            raise HTTPException(status_code=404, detail=f"Unknown variant; available: {', '.join(variants)}")
+        return _image_response(variants[variant], source, saved_name)
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status or 500, detail=f"Reconstruction failed: {job.error}")
+    if job.status == "cancelled":
+        raise HTTPException(status_code=410, detail="Reconstruction was cancelled")
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancel a queued or running reconstruction. Its worker is freed at once
+    and in-flight upstream generations are abandoned. Answers 409 when the
+    job has already finished.
+    """
+    job = _get_job(job_id)
+    if not job_queue.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    # A running job unwinds on its next await; report its final state
+    try:
+        await asyncio.wait_for(job.done.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        pass
+    return job.to_dict()
+
+
+# Idle time after which the event stream sends a comment to keep proxies from closing it
+SSE_HEARTBEAT = 15.0
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, last_event_id: str = Header(None)):
+    """
+    Stream a job's progress as Server-Sent Events: queued, started, provider
+    (each attempt), replicate_created / replicate_status / preview,
+    download, validated, generated, processing, output and finally
+    succeeded, failed or cancelled, after which the stream ends. Past
+    events are replayed first; reconnecting clients resume after
+    Last-Event-ID.
+    """
+    job = _get_job(job_id)
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+
+    async def stream():
+        async for record in job.progress.follow(after, heartbeat=SSE_HEARTBEAT):
+            yield ": keep-alive\n\n" if record is None else progress.format_sse(record)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@functools.lru_cache(maxsize=1)
+def _placeholder_png():
+    """
+    Final fallback (for testing): a visible placeholder PNG so the pipeline
+    returns a usable image instead of a tiny 1x1 pixel file. Prefers Pillow;
+    otherwise falls back to a small embedded PNG. Rendered once and reused.
+    """
     try:
-        from PIL import Image, ImageDraw, ImageFont
+        if Image is None:
+            raise ImportError("Pillow is not installed")
         # Create a 1024x1024 placeholder with simple text
         img = Image.new('RGB', (1024, 1024), color=(230, 220, 200))
         draw = ImageDraw.Draw(img)
@@ -416,8 +708,9 @@ async def reconstruct(files: List[UploadFile] = File(...), prompt: str = Form(No
             font = ImageFont.load_default()
         msg = "Placeholder image\nNo external model configured or all providers failed"
         draw.multiline_text((40, 40), msg, fill=(40, 30, 20), font=font, spacing=10)
-        img.save(output_path, format='PNG')
-        return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        return buf.getvalue()
     except Exception as e:
         print("Pillow placeholder creation failed or Pillow not installed:", e)
         # Fallback to a slightly larger embedded PNG (small but visible thumbnail)
@@ -425,52 +718,181 @@ async def reconstruct(files: List[UploadFile] = File(...), prompt: str = Form(No
         fallback_b64 = (
             "iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAQAAAC1+jfqAAAAH0lEQVR4AWP4//8/AxJgYGBg+M+A0MDAwMAAAH1AAE7p/3oAAAAAElFTkSuQmCC"
         )
-        try:
-            with open(output_path, "wb") as out:
-                out.write(base64.b64decode(fallback_b64))
-            return FileResponse(output_path, media_type="image/png", filename="reconstructed_pot.png")
-        except Exception:
-            raise HTTPException(status_code=500, detail="Image generation failed and fallback write failed")
+        return base64.b64decode(fallback_b64)
+
+
+def _sniff_media_type(data):
+    return formats.MEDIA_TYPES.get(formats.sniff(data), "image/png")
+
+
+MEDIA_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp", "image/avif": ".avif"}
+
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as out:
+        out.write(data)
+
+
+async def _persist_output(variants):
+    """
+    Save uniquely named copies of an output's variants (thumbnails get a
+    `_thumb_<side>` suffix); returns the full image's file name or None.
+    """
+    output_dir = settings.output_dir
+    base = f"reconstructed_{int(time.time())}_{uuid.uuid4().hex[:12]}"
+    names = {}
+    for variant, data in variants.items():
+        suffix = "" if variant == "full" else f"_{variant}"
+        names[variant] = base + suffix + MEDIA_EXTENSIONS[_sniff_media_type(data)]
+    try:
+        with metrics.stage("file_write"):
+            for variant, data in variants.items():
+                await asyncio.to_thread(_write_file, os.path.join(output_dir, names[variant]), data)
+    except OSError as e:
+        print("Failed to persist reconstruction:", e)
+        return None
+    return names["full"]
+
+
+def _image_response(img_bytes, source=None, saved_name=None, name="reconstructed_pot", vary_accept=False):
+    """
+    Serve generated bytes straight from memory. Inside a request timer the
+    per-stage breakdown is returned in the Server-Timing header. Set
+    `vary_accept` when the format was negotiated from the Accept header.
+    """
+    with metrics.stage("response"):
+        media_type = _sniff_media_type(img_bytes)
+        filename = name + MEDIA_EXTENSIONS[media_type]
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        if source:
+            headers["X-Reconstruct-Source"] = source
+        if saved_name:
+            headers["X-Output-File"] = saved_name
+        if vary_accept:
+            headers["Vary"] = "Accept"
+        response = Response(content=img_bytes, media_type=media_type, headers=headers)
+    timer = metrics.current_timer.get()
+    if timer is not None:
+        response.headers["Server-Timing"] = timer.server_timing()
+    return response
 
 
 @app.post("/colorize")
 async def colorize_image(file: UploadFile = File(...)):
     """
-    Endpoint to colorize a black and white heritage image.
+    Colorize a black and white heritage image with the local ONNX model
+    (COLORIZE_MODEL under models/) and return a PNG at the input resolution.
+    Answers 503 when onnxruntime or the model is not available, and 429
+    when COLORIZE_CONCURRENCY requests are already being colorized.
     """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
-    
-    # TODO: Implement colorization logic
-    
-    return JSONResponse(
-        content={
-            "message": "Image colorization in progress",
-            "filename": file.filename,
-            "status": "processing"
-        }
-    )
+    if colorizer is None:
+        raise HTTPException(status_code=503, detail="Colorization model is not loaded (see COLORIZE_MODEL)")
+    # Held from decode to PNG encode, which bounds the full-size arrays alive at once
+    if colorize_slots.locked():
+        raise HTTPException(status_code=429, detail="Too many images being colorized, retry later",
+                            headers={"Retry-After": "2"})
+
+    async with colorize_slots:
+        with metrics.request_timer("colorize"):
+            with metrics.stage("upload_read"):
+                data = await file.read()
+            try:
+                # The pixel limit is checked from the header, before any conversion
+                with metrics.stage("colorize_prepare"):
+                    lightness, model_input = await asyncio.to_thread(
+                        colorize.prepare, data, colorizer.size, colorizer.norm, settings.colorize_max_pixels)
+            except colorize.ColorizeError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            with metrics.stage("colorize_infer"):
+                ab = await colorizer.infer(model_input)
+            with metrics.stage("colorize_finish"):
+                img_bytes = await asyncio.to_thread(colorize.finish, lightness, ab, colorizer.norm)
+            return _image_response(img_bytes, name="colorized")
+
+
+@app.get("/colorize/stats")
+async def colorize_stats():
+    if colorizer is None:
+        return {"enabled": False}
+    return {"enabled": True, **colorizer.stats()}
+
+
+async def _run_cpu(task, fn, *args, wait=False, **kwargs):
+    """
+    Run CPU-bound `fn` in the worker process pool so the event loop stays
+    free. Answers 429 right away when CPU_QUEUE_MAX tasks are already queued
+    or running, which keeps queueing delay (and so latency) bounded; with
+    `wait` the caller queues for a slot instead.
+    If a worker process dies the pool is replaced and the task retried
+    once; a second failure answers 503.
+    """
+    if not wait and cpu_slots.locked():
+        raise HTTPException(status_code=429, detail="Too many images being processed, retry later",
+                            headers={"Retry-After": "2"})
+    loop = asyncio.get_running_loop()
+    call = functools.partial(fn, *args, **kwargs)
+    async with cpu_slots:
+        with metrics.CPU_TASKS.track(task=task):
+            for retry in (True, False):
+                pool = cpu_pool
+                try:
+                    return await loop.run_in_executor(pool, call)
+                except BrokenProcessPool:
+                    await _replace_cpu_pool(pool)
+                    if not retry:
+                        raise HTTPException(status_code=503, detail="Image worker crashed, retry later",
+                                            headers={"Retry-After": "2"})
 
 
 @app.post("/enhance")
-async def enhance_image(file: UploadFile = File(...)):
+async def enhance_image(file: UploadFile = File(...), denoise: float = Form(None), scale: float = Form(None),
+                        sharpen: float = Form(None), resample: str = Form(None), postprocess: str = Form(None),
+                        format: str = Form(None), quality: int = Form(None), max_side: int = Form(None),
+                        accept: str = Header(None)):
     """
-    Endpoint to enhance image quality (upscale, denoise, sharpen).
+    Enhance image quality locally (no upstream API calls): denoise, upscale
+    and sharpen, returning a PNG.
+
+    - `denoise`: 0-1 blend towards a median filter (default 0.5, 0 = off)
+    - `scale`: upscale factor 1-4 (default 2)
+    - `sharpen`: unsharp mask strength in percent, 0-500 (default 120, 0 = off)
+    - `resample`: lanczos (default), bicubic, bilinear or nearest
+    - `postprocess`: further stages run on the result in the same worker,
+      e.g. `edges` (see enhance.POSTPROCESS_STAGES)
+    - `format`, `quality`, `max_side`: output encoding as on /reconstruct
+      (PNG unless requested, negotiated from Accept or set by OUTPUT_FORMAT)
+
+    Work runs in a process pool (CPU_WORKERS); per-stage timings come back
+    in the Server-Timing header and on /metrics.
     """
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
-    
-    # TODO: Implement enhancement logic
-    
-    return JSONResponse(
-        content={
-            "message": "Image enhancement in progress",
-            "filename": file.filename,
-            "status": "processing"
-        }
-    )
+    try:
+        params = enhance.enhance_params(denoise, scale, sharpen, resample)
+        params["postprocess"] = enhance.postprocess_chain(postprocess)
+    except enhance.EnhanceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    params["output"] = _output_spec(accept, format, quality, max_side)
+
+    with metrics.request_timer("enhance"):
+        with metrics.stage("upload_read"):
+            data = await file.read()
+        start = time.perf_counter()
+        try:
+            variants, timings = await _run_cpu(
+                "enhance", enhance.enhance_bytes, data, max_pixels=settings.enhance_max_pixels, **params)
+        except enhance.EnhanceError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # Whatever the worker did not spend computing was spent waiting for it
+        metrics.observe_stage("cpu_wait", max(0.0, time.perf_counter() - start - sum(timings.values())))
+        for stage, seconds in timings.items():
+            metrics.observe_stage(f"enhance_{stage}", seconds)
+        return _image_response(variants["full"], name="enhanced", vary_accept=True)
 
 
 if __name__ == "__main__":
-    port = int(os.getenv("PORT", "8001"))
+    port = load_settings().port
     uvicorn.run(app, host="127.0.0.1", port=port, reload=True)
@@ -0,0 +1,261 @@
+"""
+Minimal Prometheus-style metrics and per-request stage timing.
+
+Counters, gauges and histograms are kept in-process and rendered in the
+Prometheus text exposition format by `render()` (served on /metrics).
+`stage()` times one step of a request: it feeds the stage histogram and, when
+a `RequestTimer` is active in the current context, the per-request breakdown
+that is logged as one JSON line and returned in the Server-Timing header.
+"""
+import contextvars
+import json
+import re
+import time
+from contextlib import contextmanager
+
+_registry = []
+_collectors = []
+
+# Latency buckets (seconds), from cheap local steps up to slow generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple((n, str(labels.get(n, ""))) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the enclosed block as in flight."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in sorted(self._values.items()):
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(float(bound))),))} {n}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+def register_collector(name, help, kind, fn):
+    """
+    Register a metric whose samples are produced at scrape time by `fn()`,
+    which returns a list of `(labels_dict, value)` pairs.
+    """
+    _collectors.append((name, help, kind, fn))
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for name, help, kind, fn in _collectors:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        try:
+            samples = fn()
+        except Exception as e:
+            print("Metrics collector", name, "failed:", e)
+            continue
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------------------------------
+# Engine metrics
+# ---------------------------------------------------------------------------
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "engine_http_request_seconds", "HTTP request latency by route and status", ("method", "route", "status"))
+HTTP_IN_FLIGHT = Gauge("engine_http_in_flight", "HTTP requests currently being served")
+STAGE_SECONDS = Histogram("engine_stage_seconds", "Time spent per reconstruction stage", ("stage",))
+PROVIDER_ATTEMPT_SECONDS = Histogram(
+    "engine_provider_attempt_seconds", "Upstream generation attempt latency", ("provider", "model", "outcome"))
+PROVIDER_IN_FLIGHT = Gauge("engine_provider_in_flight", "Upstream generations currently running", ("provider",))
+RECONSTRUCT_IN_FLIGHT = Gauge("engine_reconstructions_in_flight", "Reconstructions currently running")
+RECONSTRUCTIONS = Counter("engine_reconstructions_total", "Finished reconstructions by winning provider", ("provider",))
+FALLBACKS = Counter("engine_fallbacks_total", "Provider attempts that failed and fell through to the next one",
+                    ("provider",))
+PLACEHOLDERS = Counter("engine_placeholder_responses_total", "Responses served with the placeholder image")
+REPLICATE_POLLS = Counter("engine_replicate_polls_total", "Replicate prediction status polls", ("model",))
+CPU_TASKS = Gauge("engine_cpu_tasks_in_flight", "Tasks queued or running in the local CPU pool", ("task",))
+CPU_POOL_RESTARTS = Counter("engine_cpu_pool_restarts_total", "Local CPU pools replaced after a worker died")
+
+
+# ---------------------------------------------------------------------------
+# Per-request stage timing
+# ---------------------------------------------------------------------------
+
+current_timer = contextvars.ContextVar("current_timer", default=None)
+
+_TOKEN_RE = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+
+
+class RequestTimer:
+    def __init__(self, name):
+        self.name = name
+        self.request_id = f"{time.time_ns():x}"
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """The stages as a Server-Timing header value (durations in ms)."""
+        parts = [f"{_TOKEN_RE.sub('_', stage)};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.total() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def log(self, **extra):
+        print(json.dumps({
+            "event": f"{self.name}_timing",
+            "request_id": self.request_id,
+            "total": round(self.total(), 4),
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+            **extra,
+        }))
+
+
+@contextmanager
+def request_timer(name):
+    """Collect stage timings for the enclosed block and log them when it ends."""
+    timer = RequestTimer(name)
+    token = current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        current_timer.reset(token)
+        timer.log()
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timer = current_timer.get()
+    if timer is not None:
+        timer.add(stage, seconds)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+# ---------------------------------------------------------------------------
+# ASGI middleware
+# ---------------------------------------------------------------------------
+
+class MetricsMiddleware:
+    """Record latency and in-flight count for every HTTP request, by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            # The router stores the matched route in the scope; label by its template
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, method=scope["method"], route=route, status=status["code"])
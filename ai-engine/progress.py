@@ -0,0 +1,82 @@
+"""
+Progress events for background reconstructions.
+
+Each job carries a `Progress` log. While the job runs it is installed in the
+`current_progress` context variable, so code anywhere down the provider
+chain can call `emit()` without threading it through every signature;
+outside a job (plain /reconstruct) `emit()` is a no-op. Subscribers replay
+the log and then follow new events, which GET /jobs/{id}/events streams as
+Server-Sent Events.
+"""
+import asyncio
+import contextvars
+import json
+import time
+from collections import deque
+
+# Events kept for late subscribers; older ones are dropped first
+MAX_EVENTS = 256
+
+current_progress = contextvars.ContextVar("current_progress", default=None)
+
+
+class Progress:
+    def __init__(self, max_events=MAX_EVENTS):
+        self.events = deque(maxlen=max_events)
+        self.closed = False
+        self._seq = 0
+        self._subscribers = set()
+
+    def emit(self, event, **data):
+        if self.closed:
+            return
+        self._seq += 1
+        record = {"seq": self._seq, "event": event, "time": round(time.time(), 3), **data}
+        self.events.append(record)
+        for queue in self._subscribers:
+            queue.put_nowait(record)
+
+    def close(self):
+        """Mark the log finished; followers stop after the last event."""
+        self.closed = True
+        for queue in self._subscribers:
+            queue.put_nowait(None)
+
+    async def follow(self, after=0, heartbeat=None):
+        """
+        Yield events with a sequence number above `after`, first from the log
+        and then as they are emitted, until the log is closed. With
+        `heartbeat` seconds, None is yielded whenever that long passes
+        without an event.
+        """
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            for record in list(self.events):
+                if record["seq"] > after:
+                    yield record
+            if self.closed:
+                return
+            while True:
+                try:
+                    record = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if record is None:
+                    return
+                yield record
+        finally:
+            self._subscribers.discard(queue)
+
+
+def emit(event, **data):
+    """Record `event` on the current job's progress log, if there is one."""
+    progress = current_progress.get()
+    if progress is not None:
+        progress.emit(event, **data)
+
+
+def format_sse(record):
+    """One event as a Server-Sent Events message (the sequence number is its id)."""
+    return f"id: {record['seq']}\nevent: {record['event']}\ndata: {json.dumps(record)}\n\n"
@@ -0,0 +1,802 @@
+"""
+Shared async HTTP clients for the image generation providers.
+
+One `httpx.AsyncClient` is kept per provider for the lifetime of the app so
+that connections (and TLS sessions) are reused across requests instead of
+being re-established for every generation. HTTP/2 is enabled when the `h2`
+package is installed.
+"""
+import asyncio
+import base64
+import contextvars
+import functools
+import hashlib
+import hmac
+import re
+import time
+from collections import OrderedDict, namedtuple
+
+import httpx
+
+import metrics
+import progress
+from routing import router
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+PROVIDERS = ("openai", "replicate", "hf")
+
+# Keep-alive pool per provider. Generations are long-running, so the pool is
+# sized for concurrent in-flight requests rather than request rate.
+POOL_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=90)
+DEFAULT_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+_clients = {}
+
+# Upstream API roots; overridable (e.g. to point at bench/mock_providers.py)
+DEFAULT_BASE_URLS = {
+    "openai": "https://api.openai.com",
+    "replicate": "https://api.replicate.com",
+    "hf": "https://router.huggingface.co",
+    "hf_inference": "https://api-inference.huggingface.co",
+}
+_base_urls = dict(DEFAULT_BASE_URLS)
+
+
+def configure_base_urls(urls):
+    """Point providers at other API roots; unset (None) entries keep their defaults."""
+    _base_urls.clear()
+    _base_urls.update(DEFAULT_BASE_URLS)
+    _base_urls.update({name: url.rstrip("/") for name, url in urls.items() if url})
+
+
+def _url(name, path):
+    return _base_urls[name] + path
+
+
+# Where Replicate serves prediction outputs (e.g. pbxt.replicate.delivery)
+REPLICATE_DELIVERY_HOST = "replicate.delivery"
+
+
+def is_replicate_output_url(url):
+    """
+    True for https URLs on Replicate's delivery host, or on the configured
+    Replicate API host (so a proxy or the bench mocks can serve outputs).
+    """
+    try:
+        parsed = httpx.URL(url)
+    except (httpx.InvalidURL, TypeError):
+        return False
+    host = parsed.host.lower()
+    if parsed.scheme == "https" and (host == REPLICATE_DELIVERY_HOST or host.endswith("." + REPLICATE_DELIVERY_HOST)):
+        return True
+    api = httpx.URL(_base_urls["replicate"])
+    return (parsed.scheme, parsed.host, parsed.port) == (api.scheme, api.host, api.port)
+
+
+def _new_client():
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        limits=POOL_LIMITS,
+        timeout=DEFAULT_TIMEOUT,
+        follow_redirects=True,
+    )
+
+
+def open_clients():
+    """Create the per-provider clients. Called once on app startup."""
+    for name in PROVIDERS:
+        if name not in _clients or _clients[name].is_closed:
+            _clients[name] = _new_client()
+
+
+async def close_clients():
+    """Close all provider clients. Called once on app shutdown."""
+    while _clients:
+        _, c = _clients.popitem()
+        await c.aclose()
+
+
+def client(name):
+    """Return the shared client for `name`, creating it if startup was skipped."""
+    c = _clients.get(name)
+    if c is None or c.is_closed:
+        c = _clients[name] = _new_client()
+    return c
+
+
+# ---------------------------------------------------------------------------
+# Request deadline
+#
+# The deadline of the reconstruction being served lives in a context variable
+# so that every upstream timeout and backoff sleep below is capped to the
+# remaining budget without threading it through each call.
+# ---------------------------------------------------------------------------
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class AttemptSkipped(Exception):
+    """A backoff would outlive the deadline: give up this attempt, not the chain."""
+
+
+class Deadline:
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def _budget(timeout):
+    """Cap `timeout` to the remaining request budget, raising once it is spent."""
+    deadline = current_deadline.get()
+    remaining = deadline.remaining() if deadline else None
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    return min(timeout, remaining)
+
+
+async def _sleep(delay):
+    """
+    Backoff sleep that refuses to outlive the request deadline. Raises
+    AttemptSkipped instead, so later (possibly faster) attempts still get
+    the remaining budget.
+    """
+    deadline = current_deadline.get()
+    remaining = deadline.remaining() if deadline else None
+    if remaining is not None and remaining <= delay:
+        raise AttemptSkipped()
+    await asyncio.sleep(delay)
+
+
+def _raise_if_expired():
+    deadline = current_deadline.get()
+    if deadline and deadline.expired():
+        raise DeadlineExceeded()
+
+
+def _record(provider, model, ok, latency, error=None, hard=False, neutral=False):
+    timer = metrics.current_timer.get()
+    if timer is not None:
+        timer.add(f"{provider}:{model}", latency)
+    deadline = current_deadline.get()
+    if not ok and deadline and deadline.expired():
+        # Failures caused by our own deadline cutting a call short say nothing
+        # about the model, so they are not held against it
+        metrics.PROVIDER_ATTEMPT_SECONDS.observe(latency, provider=provider, model=model, outcome="deadline")
+        raise DeadlineExceeded()
+    metrics.PROVIDER_ATTEMPT_SECONDS.observe(latency, provider=provider, model=model,
+                                             outcome="ok" if ok else "busy" if neutral else "error")
+    router.record(provider, model, ok, latency, error=error, hard=hard, neutral=neutral)
+
+
+# ---------------------------------------------------------------------------
+# Provider generation calls
+#
+# Each function returns `(image_bytes, source)` for the first valid image it
+# obtains, or None when the provider could not produce one. Errors are logged
+# and swallowed so the caller can move on to the next provider.
+# ---------------------------------------------------------------------------
+
+MIN_IMAGE_BYTES = 2000
+
+
+def is_valid_image(data):
+    with metrics.stage("validate"):
+        ok = bool(data) and len(data) >= MIN_IMAGE_BYTES
+    progress.emit("validated", ok=ok, bytes=len(data or b""))
+    return ok
+
+
+async def _routed(provider, model, factory):
+    """Run a single-model provider call behind its circuit breaker, recording the outcome."""
+    if not router.allow(provider, model):
+        print("Skipping", provider, model, "(circuit open)")
+        return None
+    start = time.monotonic()
+    result = await factory()
+    _record(provider, model, bool(result), time.monotonic() - start,
+            error=None if result else "no valid image")
+    return result
+
+
+async def openai_generate(api_key, prompt):
+    return await _routed("openai", "gpt-image-1", lambda: _openai_generate(api_key, prompt))
+
+
+async def _openai_generate(api_key, prompt):
+    try:
+        headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        data = {
+            "model": "gpt-image-1",
+            "prompt": prompt,
+            "size": "1024x1024",
+            "n": 1
+        }
+        resp = await client("openai").post(_url("openai", "/v1/images/generations"), json=data, headers=headers, timeout=_budget(60))
+        if resp.status_code != 200:
+            try:
+                print("OpenAI error:", resp.status_code, resp.text)
+            except Exception:
+                print("OpenAI error status:", resp.status_code)
+            resp.raise_for_status()
+
+        j = resp.json()
+        if isinstance(j, dict) and "data" in j and len(j["data"]) > 0:
+            item = j["data"][0]
+            if isinstance(item, dict) and "b64_json" in item:
+                img_bytes = base64.b64decode(item["b64_json"])
+                if is_valid_image(img_bytes):
+                    return img_bytes, "openai:gpt-image-1"
+            elif isinstance(item, dict) and "url" in item:
+                progress.emit("download", provider="openai")
+                with metrics.stage("download"):
+                    r2 = await client("openai").get(item["url"], timeout=_budget(30))
+                r2.raise_for_status()
+                if is_valid_image(r2.content):
+                    return r2.content, "openai:gpt-image-1"
+        else:
+            print("Unexpected OpenAI image response format", j)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        _raise_if_expired()
+        print("OpenAI generation failed:", e)
+    return None
+
+
+# Resolved Replicate model versions: slug -> (version_id, expires_at)
+REPLICATE_VERSION_TTL = 3600
+_replicate_versions = {}
+
+# Adaptive polling: first poll soon after creation, then back off
+REPLICATE_POLL_INITIAL = 0.5
+REPLICATE_POLL_FACTOR = 1.5
+REPLICATE_POLL_MAX = 4.0
+# With webhooks enabled we still poll occasionally in case a delivery is lost
+REPLICATE_WEBHOOK_SAFETY_POLL = 10.0
+
+REPLICATE_TERMINAL = ("succeeded", "failed", "canceled")
+# Step progress in prediction logs, e.g. " 45%|####5     | 23/50 [00:05<00:06]"
+_REPLICATE_PERCENT_RE = re.compile(r"(\d{1,3})%\|")
+
+# Pending webhook deliveries: prediction id -> Future, plus deliveries that
+# arrived before anyone started waiting on them
+_replicate_waiters = {}
+_replicate_early = OrderedDict()
+
+
+async def resolve_replicate_version(headers, model_slug, ttl=REPLICATE_VERSION_TTL):
+    """Return the default version id of `model_slug`, cached for `ttl` seconds."""
+    cached = _replicate_versions.get(model_slug)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    meta_url = _url("replicate", f"/v1/models/{model_slug}")
+    mresp = await client("replicate").get(meta_url, headers=headers, timeout=_budget(30))
+    if mresp.status_code != 200:
+        print("Replicate model meta fetch failed:", mresp.status_code, mresp.text)
+        return None
+    version_id = (mresp.json().get("default_version") or {}).get("id")
+    if version_id:
+        _replicate_versions[model_slug] = (version_id, time.monotonic() + ttl)
+    return version_id
+
+
+def deliver_replicate_webhook(payload):
+    """Hand a webhook prediction payload to whoever is waiting on it."""
+    pred_id = payload.get("id")
+    if not pred_id:
+        return
+    waiter = _replicate_waiters.get(pred_id)
+    if waiter is not None and not waiter.done():
+        waiter.set_result(payload)
+        return
+    _replicate_early[pred_id] = payload
+    while len(_replicate_early) > 256:
+        _replicate_early.popitem(last=False)
+
+
+def verify_replicate_webhook(headers, body, secret, tolerance=300):
+    """
+    Check Replicate's webhook signature (`webhook-id`, `webhook-timestamp`,
+    `webhook-signature` headers, HMAC-SHA256 keyed with the `whsec_` secret).
+    """
+    msg_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not (msg_id and timestamp and signatures):
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > tolerance:
+            return False
+        key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    except ValueError:
+        return False
+    signed = f"{msg_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    for sig in signatures.split():
+        _, _, value = sig.partition(",")
+        if hmac.compare_digest(value, expected):
+            return True
+    return False
+
+
+_background_tasks = set()
+
+
+def _cancel_prediction(pred_id, headers):
+    """Best-effort cancel of an abandoned prediction, without waiting for it."""
+    async def cancel():
+        try:
+            await client("replicate").post(_url("replicate", f"/v1/predictions/{pred_id}/cancel"),
+                                           headers=headers, timeout=10)
+        except Exception as e:
+            print("Replicate cancel failed:", e)
+
+    task = asyncio.get_running_loop().create_task(cancel())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+class _PredictionReporter:
+    """Emit progress events for a prediction when its status, step or preview changes."""
+
+    def __init__(self, model_slug, pred_id):
+        self.model = model_slug
+        self.pred_id = pred_id
+        self.last = None
+        self.preview = None
+
+    def report(self, pj):
+        status = pj.get("status")
+        steps = _REPLICATE_PERCENT_RE.findall(pj.get("logs") or "")
+        percent = int(steps[-1]) if steps else None
+        if (status, percent) != self.last:
+            self.last = (status, percent)
+            progress.emit("replicate_status", model=self.model, prediction=self.pred_id,
+                          status=status, percent=percent)
+        # Some models publish intermediate images in `output` while still running
+        output = pj.get("output")
+        if status not in REPLICATE_TERMINAL and output:
+            url = output[-1] if isinstance(output, list) else output
+            if isinstance(url, str) and url != self.preview:
+                self.preview = url
+                progress.emit("preview", model=self.model, prediction=self.pred_id, url=url)
+
+
+async def _wait_for_prediction(poll_url, headers, pred_id, model_slug, max_wait, use_webhook):
+    """Wait for a prediction to finish, via webhook when enabled, else adaptive polling."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + _budget(max_wait)
+    waiter = None
+    if use_webhook:
+        waiter = _replicate_waiters[pred_id] = loop.create_future()
+        early = _replicate_early.pop(pred_id, None)
+        if early is not None:
+            waiter.set_result(early)
+    delay = REPLICATE_POLL_INITIAL
+    reporter = _PredictionReporter(model_slug, pred_id)
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            if waiter is not None:
+                await asyncio.wait({waiter}, timeout=min(REPLICATE_WEBHOOK_SAFETY_POLL, remaining))
+                if waiter.done():
+                    pj = waiter.result()
+                    reporter.report(pj)
+                    if pj.get("status") in REPLICATE_TERMINAL:
+                        return pj
+                    waiter = _replicate_waiters[pred_id] = loop.create_future()
+                    continue
+            else:
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * REPLICATE_POLL_FACTOR, REPLICATE_POLL_MAX)
+            metrics.REPLICATE_POLLS.inc(model=model_slug)
+            with metrics.stage("replicate_poll"):
+                prow = await client("replicate").get(poll_url, headers=headers, timeout=_budget(30))
+            if prow.status_code != 200:
+                print("Replicate poll error:", prow.status_code, prow.text)
+                return {"status": "failed", "error": f"poll returned {prow.status_code}"}
+            pj = prow.json()
+            reporter.report(pj)
+            if pj.get("status") in REPLICATE_TERMINAL:
+                return pj
+    finally:
+        _replicate_waiters.pop(pred_id, None)
+
+
+async def replicate_generate(token, model_slug, version_id, prompt, max_wait=120, webhook_url=None):
+    return await _routed("replicate", model_slug, lambda: _replicate_generate(
+        token, model_slug, version_id, prompt, max_wait, webhook_url))
+
+
+async def _replicate_generate(token, model_slug, version_id, prompt, max_wait, webhook_url):
+    try:
+        headers = {"Authorization": f"Token {token}", "Content-Type": "application/json"}
+        if not version_id:
+            # If a specific model version isn't provided, use the model's default_version.id
+            version_id = await resolve_replicate_version(headers, model_slug)
+        if not version_id:
+            return None
+
+        payload = {"version": version_id, "input": {"prompt": prompt}}
+        if webhook_url:
+            payload["webhook"] = webhook_url
+            payload["webhook_events_filter"] = ["completed"]
+        pr = await client("replicate").post(_url("replicate", "/v1/predictions"), json=payload, headers=headers, timeout=_budget(30))
+        if pr.status_code not in (200, 201):
+            print("Replicate create prediction failed:", pr.status_code, pr.text)
+            # The cached default version may have gone away; resolve again next time
+            _replicate_versions.pop(model_slug, None)
+            return None
+
+        pjson = pr.json()
+        pred_id = pjson.get("id")
+        pj = pjson
+        progress.emit("replicate_created", model=model_slug, prediction=pred_id, status=pjson.get("status"))
+        if pjson.get("status") not in REPLICATE_TERMINAL:
+            poll_url = _url("replicate", f"/v1/predictions/{pred_id}")
+            try:
+                pj = await _wait_for_prediction(poll_url, headers, pred_id, model_slug, max_wait, bool(webhook_url))
+            except BaseException:
+                # Cancelled (e.g. lost a race) or out of budget: stop paying for it
+                _cancel_prediction(pred_id, headers)
+                raise
+            if pj is None:
+                print("Replicate prediction timed out")
+                _cancel_prediction(pred_id, headers)
+                _raise_if_expired()
+                return None
+
+        status = pj.get("status")
+        if status != "succeeded":
+            print("Replicate prediction status:", status, pj)
+            return None
+        output_urls = pj.get("output") or pj.get("result") or []
+        if isinstance(output_urls, str):
+            output_urls = [output_urls]
+        if not isinstance(output_urls, list) or len(output_urls) == 0:
+            print("Replicate succeeded but no output found", pj)
+            return None
+        if not is_replicate_output_url(output_urls[0]):
+            print("Replicate output is not on the delivery host, not fetching it:", output_urls[0])
+            return None
+        # Download first output (could be URL string)
+        try:
+            progress.emit("download", provider="replicate", model=model_slug)
+            with metrics.stage("download"):
+                rimg = await client("replicate").get(output_urls[0], timeout=_budget(60))
+            rimg.raise_for_status()
+            if is_valid_image(rimg.content):
+                print("Replicate model succeeded", model_slug)
+                return rimg.content, f"replicate:{model_slug}"
+            print("Replicate returned tiny image")
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            _raise_if_expired()
+            print("Failed to download Replicate output:", e)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        _raise_if_expired()
+        print("Replicate generation failed:", e)
+    return None
+
+
+def _image_from_hf_response(hf_resp):
+    """Extract (unvalidated) image bytes from an HF inference response (binary or JSON/base64)."""
+    ct = hf_resp.headers.get("content-type", "")
+    if "application/json" not in ct:
+        return hf_resp.content
+    j = hf_resp.json()
+    if isinstance(j, dict) and "images" in j and len(j["images"]) > 0:
+        return base64.b64decode(j["images"][0])
+    # Search values for base64-like strings (a PNG starts with "iVBOR");
+    # the caller validates the bytes
+    for v in (j.values() if isinstance(j, dict) else []):
+        if isinstance(v, str) and v.startswith("iVBOR"):
+            return base64.b64decode(v)
+    return None
+
+
+async def hf_generate(api_key, prompt, hf_model, attempts=3, timeout=180):
+    """
+    Generate with one HF model via the router, retrying 503/transient errors
+    with backoff and falling back to the legacy api-inference endpoint when
+    the router does not serve the model. Gives up early once the model's
+    circuit breaker opens.
+    """
+    hf_headers = {"Authorization": f"Bearer {api_key}", "Accept": "application/octet-stream"}
+    hf_payload = {"inputs": prompt or "A photorealistic intact ceramic pot.", "options": {"wait_for_model": True}}
+
+    for attempt in range(1, attempts + 1):
+        if not router.allow("hf", hf_model):
+            print("Skipping HF model with open circuit:", hf_model)
+            return None
+        start = time.monotonic()
+        try:
+            hf_url = _url("hf", f"/models/{hf_model}")
+            print(f"Attempt {attempt} calling HF model {hf_model} via HF router")
+            hf_resp = await client("hf").post(hf_url, json=hf_payload, headers=hf_headers, timeout=_budget(timeout))
+            if hf_resp.status_code == 404:
+                # If router doesn't have the model, try legacy inference endpoint
+                print("Router returned 404, trying api-inference for", hf_model)
+                hf_url2 = _url("hf_inference", f"/models/{hf_model}")
+                hf_resp = await client("hf").post(hf_url2, json=hf_payload, headers=hf_headers, timeout=_budget(timeout))
+
+            if hf_resp.status_code == 503:
+                # Model loading or busy; wait and retry. A cold start is not a
+                # fault, so it does not count towards the circuit breaker
+                _record("hf", hf_model, False, time.monotonic() - start, error="503", neutral=True)
+                print("Model loading/busy, retrying after backoff")
+                progress.emit("provider_busy", provider="hf", model=hf_model, attempt=attempt)
+                if attempt < attempts:
+                    await _sleep(5 * attempt)
+                continue
+
+            if hf_resp.status_code != 200:
+                _record("hf", hf_model, False, time.monotonic() - start,
+                        error=str(hf_resp.status_code), hard=hf_resp.status_code in (404, 410))
+                try:
+                    print("HF error response for", hf_model, hf_resp.status_code, hf_resp.text[:400])
+                except Exception:
+                    print("HF error status for", hf_model, hf_resp.status_code)
+                return None
+
+            img_bytes = _image_from_hf_response(hf_resp)
+            if img_bytes is None:
+                _record("hf", hf_model, False, time.monotonic() - start, error="unexpected JSON")
+                print("HF JSON response unexpected; trying next model")
+                return None
+            if not is_valid_image(img_bytes):
+                _record("hf", hf_model, False, time.monotonic() - start, error="tiny image")
+                print("HF returned tiny/bad image for", hf_model)
+                if attempt < attempts:
+                    await _sleep(1)
+                continue
+            _record("hf", hf_model, True, time.monotonic() - start)
+            print("HF model produced image", hf_model)
+            return img_bytes, f"hf:{hf_model}"
+        except (DeadlineExceeded, AttemptSkipped):
+            raise
+        except Exception as e:
+            _record("hf", hf_model, False, time.monotonic() - start, error=e.__class__.__name__)
+            print(f"HF attempt {attempt} for {hf_model} failed:", e)
+            if attempt < attempts:
+                await _sleep(2 * attempt)
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Attempt plan
+# ---------------------------------------------------------------------------
+
+class Attempt(namedtuple("Attempt", "provider model options")):
+    """One (provider, model) generation attempt with its call options."""
+
+
+@functools.lru_cache(maxsize=32)
+def compile_plan(entries):
+    """
+    Compile an ordered chain of `(provider, model, options)` entries (options
+    as a tuple of key/value pairs, so the chain is hashable) into a tuple of
+    Attempts, keeping only the first occurrence of each
+    (provider, model) so no request tries the same model twice.
+    """
+    seen = set()
+    plan = []
+    for provider, model, options in entries:
+        model = model.strip() if model else model
+        if (provider, model) in seen:
+            continue
+        seen.add((provider, model))
+        plan.append(Attempt(provider, model, dict(options)))
+    return tuple(plan)
+
+
+def order_plan(plan):
+    """
+    Re-order the attempts of each provider by expected time to a valid image
+    (dropping models whose circuit is open), keeping the provider positions.
+    """
+    by_provider = {}
+    for attempt in plan:
+        by_provider.setdefault(attempt.provider, []).append(attempt)
+    ordered = {}
+    for provider, attempts in by_provider.items():
+        lookup = {a.model: a for a in attempts}
+        ordered[provider] = iter([lookup[m] for m in router.order(provider, [a.model for a in attempts])])
+    out = []
+    for attempt in plan:
+        nxt = next(ordered[attempt.provider], None)
+        if nxt is not None:
+            out.append(nxt)
+    return out
+
+
+async def run_attempt(attempt, credentials, prompt):
+    progress.emit("provider", provider=attempt.provider, model=attempt.model)
+    try:
+        result = await _run_attempt(attempt, credentials, prompt)
+    except AttemptSkipped:
+        print("Giving up on", attempt.provider, attempt.model, "(backoff would pass the deadline)")
+        result = None
+    if not result:
+        progress.emit("provider_failed", provider=attempt.provider, model=attempt.model)
+    return result
+
+
+async def _run_attempt(attempt, credentials, prompt):
+    options = attempt.options
+    if attempt.provider == "openai":
+        return await openai_generate(credentials["openai"], prompt)
+    if attempt.provider == "replicate":
+        return await replicate_generate(credentials["replicate"], attempt.model, options.get("version"), prompt,
+                                        max_wait=options.get("max_wait", 120), webhook_url=options.get("webhook_url"))
+    if attempt.provider == "hf":
+        return await hf_generate(credentials["hf"], prompt, attempt.model,
+                                 attempts=options.get("attempts", 3), timeout=options.get("timeout", 180))
+    raise ValueError(f"Unknown provider {attempt.provider}")
+
+
+async def _warm_openai(api_key):
+    resp = await client("openai").get(_url("openai", "/v1/models"),
+                                      headers={"Authorization": f"Bearer {api_key}"}, timeout=30)
+    print("Warm-up: OpenAI", resp.status_code)
+
+
+async def _warm_replicate(token, model_slug):
+    headers = {"Authorization": f"Token {token}", "Content-Type": "application/json"}
+    version_id = await resolve_replicate_version(headers, model_slug)
+    print("Warm-up: Replicate", model_slug, "version", version_id)
+
+
+async def _warm_hf(api_key, hf_model):
+    # A minimal generation makes the router load the model (wait_for_model)
+    hf_headers = {"Authorization": f"Bearer {api_key}", "Accept": "application/octet-stream"}
+    payload = {
+        "inputs": "warm-up",
+        "parameters": {"num_inference_steps": 1, "width": 64, "height": 64},
+        "options": {"wait_for_model": True},
+    }
+    start = time.monotonic()
+    resp = await client("hf").post(_url("hf", f"/models/{hf_model}"),
+                                   json=payload, headers=hf_headers, timeout=120)
+    if resp.status_code in (404, 410):
+        # Not served at all: open its breaker before a user request pays for it
+        router.record("hf", hf_model, False, time.monotonic() - start, error=str(resp.status_code), hard=True)
+    print("Warm-up: HF", hf_model, resp.status_code)
+
+
+async def warm_up(plan, credentials, hf_models=2):
+    """
+    Open provider connections, resolve Replicate model versions and load
+    the first `hf_models` HF models of `plan` before serving requests.
+    """
+    tasks = []
+    hf_seen = 0
+    for attempt in plan:
+        if attempt.provider == "openai":
+            tasks.append(_warm_openai(credentials["openai"]))
+        elif attempt.provider == "replicate" and not attempt.options.get("version"):
+            tasks.append(_warm_replicate(credentials["replicate"], attempt.model))
+        elif attempt.provider == "hf" and hf_seen < hf_models:
+            hf_seen += 1
+            tasks.append(_warm_hf(credentials["hf"], attempt.model))
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            print("Warm-up step failed:", result)
+
+
+# ---------------------------------------------------------------------------
+# Chain execution
+# ---------------------------------------------------------------------------
+
+EXECUTION_MODES = ("sequential", "race", "hedge")
+
+# Number of concurrent upstream generations allowed per provider.
+_concurrency = {"openai": 4, "replicate": 4, "hf": 2}
+_semaphores = {}
+
+
+def configure_concurrency(limits):
+    """Set per-provider caps. Calls already holding a slot finish under the old cap."""
+    _concurrency.update(limits)
+    _semaphores.clear()
+
+
+def concurrency_limit(name):
+    sem = _semaphores.get(name)
+    if sem is None:
+        sem = _semaphores[name] = asyncio.Semaphore(max(1, _concurrency.get(name, 2)))
+    return sem
+
+
+async def _run_step(step):
+    provider, factory = step
+    async with concurrency_limit(provider):
+        with metrics.PROVIDER_IN_FLIGHT.track(provider=provider):
+            return await factory()
+
+
+async def _run_lane(lane):
+    for step in lane:
+        result = await _run_step(step)
+        if result:
+            return result
+        metrics.FALLBACKS.inc(provider=step[0])
+    return None
+
+
+async def run_chain(steps, mode="sequential", hedge_delay=0.0):
+    """
+    Run provider `steps` (a list of `(provider, coroutine_factory)` tuples)
+    and return the first valid `(image_bytes, source)` result, or None.
+
+    - sequential: steps run one after another, in order.
+    - race: steps are grouped into one lane per provider (keeping their order
+      inside the lane) and all lanes start at once.
+    - hedge: like race, but each further lane only starts after `hedge_delay`
+      seconds without a winner, or as soon as a running lane gives up.
+
+    The first lane to return a valid image wins; the others are cancelled.
+    """
+    if mode == "sequential":
+        return await _run_lane(steps)
+
+    lanes = {}
+    for step in steps:
+        lanes.setdefault(step[0], []).append(step)
+    waiting = list(lanes.values())
+    if mode == "race":
+        hedge_delay = 0.0
+
+    running = set()
+    try:
+        while waiting or running:
+            if waiting:
+                running.add(asyncio.create_task(_run_lane(waiting.pop(0))))
+                if hedge_delay <= 0:
+                    continue
+            done, running = await asyncio.wait(
+                running,
+                timeout=hedge_delay if waiting else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                try:
+                    result = task.result()
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    print("Provider lane failed:", e)
+                    continue
+                if result:
+                    return result
+        return None
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
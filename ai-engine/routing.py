@@ -0,0 +1,178 @@
+"""
+Latency-aware routing across provider models.
+
+Every upstream attempt is recorded per (provider, model) in a rolling window
+so we know each model's recent success rate and latency percentiles. Models
+that keep failing are put behind a circuit breaker: they are skipped while
+the breaker is open, and after a cool-down a single half-open probe decides
+whether they come back. Candidates are ordered by expected time to a valid
+image (median successful latency divided by a smoothed success rate).
+"""
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# A half-open probe that never reported back (e.g. its request was cancelled)
+# is given up on after this many seconds
+PROBE_TIMEOUT = 300.0
+
+# Assumed for models without any recorded attempts yet
+PRIOR_LATENCY = 30.0
+PRIOR_SUCCESS = 0.5
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+class ModelStats:
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)  # (ok, latency)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.trips = 0
+        self.probe_started = None
+        self.last_error = None
+        self.busy = 0
+
+    def success_rate(self):
+        if not self.samples:
+            return None
+        return sum(1 for ok, _ in self.samples if ok) / len(self.samples)
+
+    def latencies(self, successes_only=False):
+        return [lat for ok, lat in self.samples if ok or not successes_only]
+
+    def expected_time(self):
+        """Median successful latency over a smoothed success rate (retries included)."""
+        successes = sum(1 for ok, _ in self.samples if ok)
+        # Laplace smoothing keeps a single lucky/unlucky attempt from dominating
+        rate = (successes + 2 * PRIOR_SUCCESS) / (len(self.samples) + 2)
+        ok_lat = self.latencies(successes_only=True)
+        if ok_lat:
+            latency = _percentile(ok_lat, 0.5)
+        else:
+            latency = max(PRIOR_LATENCY, _percentile(self.latencies(), 0.95) or 0.0)
+        return latency / rate
+
+
+class Router:
+    def __init__(self, window=50, failure_threshold=3, cooldown=60.0, max_cooldown=900.0):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._models = {}
+
+    def _get(self, provider, model):
+        key = (provider, model)
+        stats = self._models.get(key)
+        if stats is None:
+            stats = self._models[key] = ModelStats(self.window)
+        return stats
+
+    def _refresh(self, stats):
+        if stats.state == OPEN and time.monotonic() - stats.opened_at >= stats.cooldown:
+            stats.state = HALF_OPEN
+            stats.probe_started = None
+
+    def available(self, provider, model):
+        """True unless the model's breaker is open (or its half-open probe is taken)."""
+        stats = self._get(provider, model)
+        self._refresh(stats)
+        if stats.state == OPEN:
+            return False
+        if stats.state == HALF_OPEN:
+            return stats.probe_started is None or time.monotonic() - stats.probe_started >= PROBE_TIMEOUT
+        return True
+
+    def allow(self, provider, model):
+        """Like available(), but claims the half-open probe slot when granted."""
+        if not self.available(provider, model):
+            return False
+        stats = self._get(provider, model)
+        if stats.state == HALF_OPEN:
+            stats.probe_started = time.monotonic()
+        return True
+
+    def order(self, provider, models):
+        """Drop duplicates and open circuits, then sort by expected time to a valid image."""
+        seen = set()
+        candidates = []
+        for m in models:
+            if m in seen:
+                continue
+            seen.add(m)
+            if self.available(provider, m):
+                candidates.append(m)
+        # sorted() is stable, so configured order breaks ties
+        return sorted(candidates, key=lambda m: self._get(provider, m).expected_time())
+
+    def record(self, provider, model, ok, latency, error=None, hard=False, neutral=False):
+        """
+        Record one attempt. `hard` failures (e.g. 404: the model is not served)
+        open the breaker immediately instead of after `failure_threshold`.
+        `neutral` failures (e.g. a 503 while the model is loading) say nothing
+        about its health: they are counted but leave the window and the
+        breaker alone, apart from freeing a half-open probe slot.
+        """
+        stats = self._get(provider, model)
+        stats.probe_started = None
+        if neutral:
+            stats.busy += 1
+            return
+        stats.samples.append((bool(ok), float(latency)))
+        if ok:
+            stats.state = CLOSED
+            stats.consecutive_failures = 0
+            stats.cooldown = 0.0
+            stats.last_error = None
+            return
+        stats.consecutive_failures += 1
+        stats.last_error = error
+        if stats.state == HALF_OPEN or hard or stats.consecutive_failures >= self.failure_threshold:
+            # Back off exponentially while the model keeps failing its probes
+            stats.cooldown = min(self.max_cooldown, max(self.base_cooldown, stats.cooldown * 2))
+            stats.state = OPEN
+            stats.opened_at = time.monotonic()
+            stats.trips += 1
+
+    def stats(self):
+        out = []
+        for (provider, model), s in self._models.items():
+            self._refresh(s)
+            rate = s.success_rate()
+            lat = s.latencies()
+            p50 = _percentile(lat, 0.5)
+            p95 = _percentile(lat, 0.95)
+            retry_in = None
+            if s.state == OPEN:
+                retry_in = round(max(0.0, s.cooldown - (time.monotonic() - s.opened_at)), 1)
+            out.append({
+                "provider": provider,
+                "model": model,
+                "state": s.state,
+                "attempts": len(s.samples),
+                "success_rate": round(rate, 3) if rate is not None else None,
+                "p50_latency": round(p50, 3) if p50 is not None else None,
+                "p95_latency": round(p95, 3) if p95 is not None else None,
+                "expected_time": round(s.expected_time(), 3),
+                "consecutive_failures": s.consecutive_failures,
+                "trips": s.trips,
+                "busy": s.busy,
+                "retry_in": retry_in,
+                "last_error": s.last_error,
+            })
+        return sorted(out, key=lambda r: (r["provider"], r["expected_time"]))
+
+
+router = Router()
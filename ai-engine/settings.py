@@ -0,0 +1,221 @@
+"""
+Engine configuration, parsed and validated once from the environment (and
+the .env file) at startup instead of on every request. `load_settings()` can
+be called again to pick up edits; invalid values raise SettingsError listing
+every problem, so a bad reload never replaces a working configuration.
+"""
+import os
+
+from dotenv import dotenv_values, find_dotenv
+
+from formats import MAX_SIDE
+from providers import EXECUTION_MODES
+
+# The process environment wins over .env values, as with load_dotenv()
+_PROCESS_ENV = dict(os.environ)
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+FALSE_VALUES = ("0", "false", "no", "off", "")
+
+# OUTPUT_FORMAT values: "original" or one of formats.MEDIA_TYPES
+OUTPUT_FORMATS = ("original", "avif", "webp", "jpeg", "png")
+
+# Environment variables that hold credentials; never echoed back
+SECRETS = ("openai_api_key", "replicate_api_token", "replicate_webhook_secret", "hf_api_key", "admin_token")
+
+
+class SettingsError(ValueError):
+    pass
+
+
+class Settings:
+    def __init__(self, env):
+        self._env = env
+        self._errors = []
+
+        # Provider credentials and models
+        self.openai_api_key = self._str("OPENAI_API_KEY")
+        self.replicate_api_token = self._str("REPLICATE_API_TOKEN")
+        self.replicate_model = self._str("REPLICATE_MODEL")
+        self.replicate_model_version = self._str("REPLICATE_MODEL_VERSION")
+        self.replicate_webhook_url = self._str("REPLICATE_WEBHOOK_URL")
+        self.replicate_webhook_secret = self._str("REPLICATE_WEBHOOK_SECRET")
+        self.hf_api_key = self._str("HF_API_KEY")
+        self.hf_model = self._str("HF_MODEL")
+        # API roots, for proxies or the local stand-ins in bench/mock_providers.py
+        self.base_urls = {
+            "openai": self._str("OPENAI_BASE_URL"),
+            "replicate": self._str("REPLICATE_BASE_URL"),
+            "hf": self._str("HF_BASE_URL"),
+            "hf_inference": self._str("HF_INFERENCE_BASE_URL"),
+        }
+
+        # Request handling
+        self.reconstruct_mode = self._choice("RECONSTRUCT_MODE", "sequential", EXECUTION_MODES)
+        self.hedge_delay = self._float("RECONSTRUCT_HEDGE_DELAY", 5.0, minimum=0)
+        self.deadline = self._float("RECONSTRUCT_DEADLINE", 300.0, minimum=0)
+        self.persist = self._bool("RECONSTRUCT_PERSIST", False)
+        self.output_dir = self._str("RECONSTRUCT_OUTPUT_DIR") or os.path.join(os.path.dirname(__file__), "outputs")
+        self.provider_concurrency = {
+            "openai": self._int("PROVIDER_CONCURRENCY_OPENAI", 4, minimum=1),
+            "replicate": self._int("PROVIDER_CONCURRENCY_REPLICATE", 4, minimum=1),
+            "hf": self._int("PROVIDER_CONCURRENCY_HF", 2, minimum=1),
+        }
+
+        # Fragment uploads: count and size caps (413 beyond them), the pixel
+        # limit checked from image headers, and whether fragment colours and
+        # proportions are added to the prompt
+        self.upload_max_files = self._int("UPLOAD_MAX_FILES", 10, minimum=1)
+        self.upload_max_file_mb = self._float("UPLOAD_MAX_FILE_MB", 15.0, minimum=0.01)
+        self.upload_max_total_mb = self._float("UPLOAD_MAX_TOTAL_MB", 50.0, minimum=0.01)
+        self.fragment_max_pixels = self._int("FRAGMENT_MAX_PIXELS", 50_000_000, minimum=1)
+        self.fragment_hints = self._bool("FRAGMENT_HINTS", True)
+
+        # Output encoding; requests can override with format/quality/max_side
+        # or an Accept header. "original" serves provider bytes unchanged.
+        self.output_format = self._choice("OUTPUT_FORMAT", "original", OUTPUT_FORMATS)
+        self.output_quality = self._int("OUTPUT_QUALITY", 80, minimum=1, maximum=100)
+        # 0 = no cap; otherwise the range formats.output_spec accepts
+        self.output_max_side = self._int("OUTPUT_MAX_SIDE", 0, minimum=0, maximum=MAX_SIDE)
+        if 0 < self.output_max_side < 16:
+            self._errors.append(f"OUTPUT_MAX_SIDE must be 0 or >= 16, got {self.output_max_side}")
+            self.output_max_side = 0
+        # Thumbnail sizes (longest side) rendered for jobs and persisted outputs
+        self.thumbnail_sides = self._int_list("THUMBNAIL_SIDES", (256,), minimum=16, maximum=MAX_SIDE)
+
+        # Result cache (applied at startup)
+        self.cache_enabled = self._bool("RECONSTRUCT_CACHE", True)
+        self.cache_memory_mb = self._int("RECONSTRUCT_CACHE_MEMORY_MB", 64, minimum=0)
+        self.cache_disk_mb = self._int("RECONSTRUCT_CACHE_DISK_MB", 512, minimum=0)
+        self.cache_dir = self._str("RECONSTRUCT_CACHE_DIR") or os.path.join(os.path.dirname(__file__), "cache")
+
+        # Job pool (applied at startup)
+        self.job_workers = self._int("JOB_WORKERS", 4, minimum=1)
+        self.job_queue_max = self._int("JOB_QUEUE_MAX", 32, minimum=1)
+        self.job_ttl = self._int("JOB_TTL_SECONDS", 3600, minimum=1)
+        # Finished jobs kept for their results; the oldest go first beyond either cap
+        self.job_max_retained = self._int("JOB_MAX_RETAINED", 256, minimum=1)
+        self.job_max_retained_mb = self._int("JOB_MAX_RETAINED_MB", 256, minimum=1)
+
+        # Local CPU work (/enhance); pool sizes apply at startup
+        self.cpu_workers = self._int("CPU_WORKERS", os.cpu_count() or 1, minimum=1)
+        self.cpu_queue_max = self._int("CPU_QUEUE_MAX", 16, minimum=1)
+        self.enhance_max_pixels = self._int("ENHANCE_MAX_PIXELS", 40_000_000, minimum=1)
+
+        # Colorization model (applied at startup); COLORIZE_MODEL is a path
+        # or a file name under models/
+        self.colorize_model = self._str("COLORIZE_MODEL") or "colorizer.onnx"
+        self.colorize_sessions = self._int("COLORIZE_SESSIONS", 2, minimum=1)
+        self.colorize_max_batch = self._int("COLORIZE_MAX_BATCH", 8, minimum=1)
+        self.colorize_batch_wait_ms = self._float("COLORIZE_BATCH_WAIT_MS", 10.0, minimum=0)
+        # Full-resolution Lab arrays take ~40 bytes per pixel while a request
+        # is converted, so both the input size and the number of requests
+        # converting at once (429 beyond it) are capped
+        self.colorize_max_pixels = self._int("COLORIZE_MAX_PIXELS", 16_000_000, minimum=1)
+        self.colorize_concurrency = self._int("COLORIZE_CONCURRENCY", 2, minimum=1)
+
+        # Warm-up before serving the first request
+        self.warmup = self._bool("WARMUP", False)
+        self.warmup_timeout = self._float("WARMUP_TIMEOUT", 60.0, minimum=0)
+        self.warmup_hf_models = self._int("WARMUP_HF_MODELS", 2, minimum=0)
+
+        # X-Admin-Token for /admin/*; without it those endpoints answer 404
+        self.admin_token = self._str("ADMIN_TOKEN")
+        self.port = self._int("PORT", 8001, minimum=1)
+
+        # Unsigned completions would let anyone post a fake prediction result
+        if self.replicate_webhook_url and not self.replicate_webhook_secret:
+            self._errors.append("REPLICATE_WEBHOOK_URL requires REPLICATE_WEBHOOK_SECRET")
+
+        if self._errors:
+            raise SettingsError("; ".join(self._errors))
+        del self._env, self._errors
+
+    # -- parsing helpers ---------------------------------------------------
+
+    def _str(self, name):
+        value = self._env.get(name)
+        return value.strip() if value and value.strip() else None
+
+    def _bool(self, name, default):
+        value = self._env.get(name)
+        if value is None:
+            return default
+        value = value.strip().lower()
+        if value in TRUE_VALUES:
+            return True
+        if value in FALSE_VALUES:
+            return False
+        self._errors.append(f"{name} must be a boolean, got {value!r}")
+        return default
+
+    def _number(self, name, default, cast, minimum, maximum=None):
+        value = self._env.get(name)
+        if value is None or not value.strip():
+            return default
+        try:
+            number = cast(value)
+        except ValueError:
+            self._errors.append(f"{name} must be a number, got {value!r}")
+            return default
+        if minimum is not None and number < minimum:
+            self._errors.append(f"{name} must be >= {minimum}, got {number}")
+            return default
+        if maximum is not None and number > maximum:
+            self._errors.append(f"{name} must be <= {maximum}, got {number}")
+            return default
+        return number
+
+    def _int(self, name, default, minimum=None, maximum=None):
+        return self._number(name, default, int, minimum, maximum)
+
+    def _float(self, name, default, minimum=None, maximum=None):
+        return self._number(name, default, float, minimum, maximum)
+
+    def _int_list(self, name, default, minimum=None, maximum=None):
+        value = self._env.get(name)
+        if value is None:
+            return default
+        numbers = []
+        for part in value.replace(" ", ",").split(","):
+            if not part:
+                continue
+            try:
+                number = int(part)
+            except ValueError:
+                self._errors.append(f"{name} must be a comma-separated list of integers, got {value!r}")
+                return default
+            if minimum is not None and number < minimum:
+                self._errors.append(f"{name} values must be >= {minimum}, got {number}")
+                return default
+            if maximum is not None and number > maximum:
+                self._errors.append(f"{name} values must be <= {maximum}, got {number}")
+                return default
+            numbers.append(number)
+        return tuple(numbers)
+
+    def _choice(self, name, default, choices):
+        value = (self._env.get(name) or default).strip().lower()
+        if value not in choices:
+            self._errors.append(f"{name} must be one of {', '.join(choices)}, got {value!r}")
+            return default
+        return value
+
+    # -- views -------------------------------------------------------------
+
+    def summary(self):
+        """Settings as a dict, with secrets reduced to whether they are set."""
+        out = {}
+        for key, value in vars(self).items():
+            if key in SECRETS:
+                out[key] = bool(value)
+            else:
+                out[key] = value
+        return out
+
+
+def load_settings():
+    """(Re)read the .env file and parse it together with the process environment."""
+    env = {k: v for k, v in dotenv_values(find_dotenv()).items() if v is not None}
+    env.update(_PROCESS_ENV)
+    return Settings(env)
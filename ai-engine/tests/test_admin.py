@@ -0,0 +1,44 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import settings
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def make(token):
+        monkeypatch.setitem(settings._PROCESS_ENV, "ADMIN_TOKEN", token)
+        monkeypatch.setitem(settings._PROCESS_ENV, "WARMUP", "false")
+        return TestClient(main.app)
+    return make
+
+
+def test_admin_endpoints_are_off_without_a_token(client):
+    with client("") as c:
+        assert c.get("/admin/settings").status_code == 404
+        assert c.post("/admin/reload", headers={"X-Admin-Token": "anything"}).status_code == 404
+
+
+def test_wrong_or_missing_token_is_refused(client):
+    with client("s3cret") as c:
+        assert c.get("/admin/settings").status_code == 403
+        assert c.get("/admin/settings", headers={"X-Admin-Token": "s3cre"}).status_code == 403
+
+
+def test_settings_hide_secrets(client, monkeypatch):
+    monkeypatch.setitem(settings._PROCESS_ENV, "OPENAI_API_KEY", "sk-test")
+    with client("s3cret") as c:
+        resp = c.get("/admin/settings", headers={"X-Admin-Token": "s3cret"})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["openai_api_key"] is True and body["admin_token"] is True
+    assert "sk-test" not in resp.text
+
+
+def test_reload_applies_new_settings(client, monkeypatch):
+    with client("s3cret") as c:
+        monkeypatch.setitem(settings._PROCESS_ENV, "RECONSTRUCT_HEDGE_DELAY", "1.5")
+        resp = c.post("/admin/reload", headers={"X-Admin-Token": "s3cret"})
+        assert resp.status_code == 200
+        assert main.settings.hedge_delay == 1.5
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import providers
+from cache import ReconstructionCache, make_key
+
+ENTRY = (b"image bytes", "openai:gpt-image-1")
+
+
+def test_concurrent_callers_share_one_generation():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return ENTRY
+
+    async def run():
+        cache = ReconstructionCache()
+        results = await asyncio.gather(*(cache.get_or_create("k", factory) for _ in range(3)))
+        return cache, results
+
+    cache, results = asyncio.run(run())
+    assert results == [ENTRY] * 3
+    assert len(calls) == 1
+    assert cache.counters["coalesced"] == 2
+    assert cache.counters["misses"] == 1
+
+
+def test_shared_failure_reaches_every_caller():
+    async def factory():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream broke")
+
+    async def run():
+        cache = ReconstructionCache()
+        return await asyncio.gather(*(cache.get_or_create("k", factory) for _ in range(2)),
+                                    return_exceptions=True)
+
+    assert all(isinstance(r, RuntimeError) for r in asyncio.run(run()))
+
+
+def test_leader_deadline_does_not_fail_follower_with_time_left():
+    """Two coalesced callers: the leader's 0.05s budget runs out, the follower's 5s does not."""
+    calls = []
+
+    def generate(deadline):
+        async def factory():
+            calls.append(deadline.seconds)
+            await asyncio.sleep(0.1)
+            if deadline.expired():
+                raise providers.DeadlineExceeded()
+            return ENTRY
+        return factory
+
+    async def run():
+        cache = ReconstructionCache()
+        errors = (providers.DeadlineExceeded,)
+        leader = asyncio.create_task(
+            cache.get_or_create("k", generate(providers.Deadline(0.05)), private_errors=errors))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(
+            cache.get_or_create("k", generate(providers.Deadline(5)), private_errors=errors))
+        with pytest.raises(providers.DeadlineExceeded):
+            await leader
+        return await follower, cache
+
+    result, cache = asyncio.run(run())
+    assert result == ENTRY
+    assert calls == [0.05, 5]
+    assert cache.stats()["inflight"] == 0
+
+
+def test_disk_tier_survives_a_new_instance(tmp_path):
+    key = make_key(["a" * 64], "a pot", [["openai", "gpt-image-1", None]])
+
+    async def run():
+        first = ReconstructionCache(disk_dir=str(tmp_path))
+        await first.put(key, ENTRY)
+        # A fresh cache (as after a restart) finds the entry on disk only
+        second = ReconstructionCache(disk_dir=str(tmp_path))
+        entry = await second.get(key)
+        again = await second.get(key)
+        return second, entry, again
+
+    second, entry, again = asyncio.run(run())
+    assert entry == again == ENTRY
+    assert second.counters["disk_hits"] == 1
+    assert second.counters["memory_hits"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    async def run():
+        cache = ReconstructionCache(memory_max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=100)
+        await cache.put("aa1", (b"x" * 40, "s"))
+        await cache.put("bb2", (b"y" * 40, "s"))
+        await cache.get("aa1")
+        await cache.put("cc3", (b"z" * 40, "s"))
+        return cache, [await cache.get(k) for k in ("aa1", "bb2", "cc3")]
+
+    cache, entries = asyncio.run(run())
+    assert entries[1] is None and entries[0] and entries[2]
+    assert cache.counters["evictions"] == 1
@@ -0,0 +1,34 @@
+import io
+import os
+import signal
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+import settings
+
+
+def _png(side=64):
+    buf = io.BytesIO()
+    Image.radial_gradient("L").resize((side, side)).convert("RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _enhance(client):
+    return client.post("/enhance", data={"scale": "1"}, files={"file": ("in.png", _png(), "image/png")})
+
+
+def test_enhance_recovers_after_a_worker_is_killed(monkeypatch):
+    for name, value in {"CPU_WORKERS": "1", "WARMUP": "false", "RECONSTRUCT_CACHE": "false"}.items():
+        monkeypatch.setitem(settings._PROCESS_ENV, name, value)
+    with TestClient(main.app) as client:
+        assert _enhance(client).status_code == 200
+        broken = main.cpu_pool
+        for pid in list(broken._processes):
+            os.kill(pid, signal.SIGKILL)
+
+        resp = _enhance(client)
+        assert resp.status_code == 200
+        assert main.cpu_pool is not broken
+        assert _enhance(client).status_code == 200
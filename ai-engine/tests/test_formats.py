@@ -0,0 +1,56 @@
+import io
+
+import pytest
+from PIL import Image
+
+import formats
+
+
+def _encoded(fmt, size=(64, 48)):
+    buf = io.BytesIO()
+    Image.radial_gradient("L").resize(size).convert("RGB").save(buf, format=fmt)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize("kwargs", [{"quality": 0}, {"quality": 101}, {"max_side": 0}, {"max_side": 10 ** 6},
+                                    {"format": "gif"}])
+def test_invalid_output_fields_are_rejected(kwargs):
+    with pytest.raises(formats.FormatError):
+        formats.output_spec(**{"format": "webp", **kwargs})
+
+
+def test_accept_header_negotiation():
+    assert formats.negotiate("image/webp,image/png;q=0.5") == "webp"
+    assert formats.negotiate("image/png, image/jpeg;q=0.9") == "png"
+    assert formats.negotiate("*/*") is None
+    assert formats.output_spec(accept="text/html,*/*") is None
+
+
+def test_sniff():
+    assert formats.sniff(_encoded("PNG")) == "png"
+    assert formats.sniff(_encoded("JPEG")) == "jpeg"
+    assert formats.sniff(_encoded("WEBP")) == "webp"
+    assert formats.sniff(b"not an image") is None
+
+
+def test_matching_format_passes_original_bytes_through():
+    png = _encoded("PNG")
+    spec = formats.output_spec(accept="image/png")
+    assert formats.passes_through(spec, png)
+    assert formats.render(Image.open(io.BytesIO(png)), spec, png)["full"] is png
+
+
+def test_resize_or_other_format_re_encodes():
+    png = _encoded("PNG")
+    assert not formats.passes_through(formats.output_spec(format="png", max_side=32), png)
+    spec = formats.output_spec(format="jpeg")
+    assert not formats.passes_through(spec, png)
+    assert formats.sniff(formats.render(Image.open(io.BytesIO(png)), spec, png)["full"]) == "jpeg"
+
+
+def test_thumbnails_come_from_the_same_decode():
+    png = _encoded("PNG", (400, 200))
+    spec = formats.output_spec(format="webp", thumbnails=(64, 128))
+    variants = formats.render(Image.open(io.BytesIO(png)), spec, png)
+    assert set(variants) == {"full", "thumb_128", "thumb_64"}
+    assert Image.open(io.BytesIO(variants["thumb_64"])).size == (64, 32)
@@ -0,0 +1,96 @@
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+import settings
+
+
+def _jpeg(side=64, padding=0):
+    buf = io.BytesIO()
+    Image.radial_gradient("L").resize((side, side)).convert("RGB").save(buf, format="JPEG")
+    # Pillow ignores bytes after the end-of-image marker
+    return buf.getvalue() + b"\0" * padding
+
+
+def _client(monkeypatch, tmp_path, **env):
+    base = {"OPENAI_API_KEY": "", "REPLICATE_API_TOKEN": "", "HF_API_KEY": "", "WARMUP": "false",
+            "RECONSTRUCT_CACHE": "false", "RECONSTRUCT_PERSIST": "false", "RECONSTRUCT_OUTPUT_DIR": str(tmp_path)}
+    for name, value in {**base, **env}.items():
+        monkeypatch.setitem(settings._PROCESS_ENV, name, value)
+    monkeypatch.chdir(tmp_path)
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def small_limit(monkeypatch, tmp_path):
+    # 100 KiB of fragments, plus the fixed multipart allowance
+    with _client(monkeypatch, tmp_path, UPLOAD_MAX_TOTAL_MB="0.09765625") as c:
+        yield c
+
+
+def _over_body_limit():
+    return 100 * 1024 + main.fragments.BODY_OVERHEAD + 1
+
+
+@pytest.mark.parametrize("path", ["/reconstruct", "/jobs/reconstruct"])
+def test_content_length_over_limit_answers_413(small_limit, path):
+    resp = small_limit.post(path, data={"prompt": "a pot"},
+                            files={"files": ("f.jpg", _jpeg(padding=_over_body_limit()), "image/jpeg")})
+    assert resp.status_code == 413
+    assert "upload limit" in resp.json()["detail"]
+
+
+def test_chunked_body_over_limit_answers_413(small_limit):
+    def body():
+        for _ in range(_over_body_limit() // 8192 + 1):
+            yield b"\0" * 8192
+
+    resp = small_limit.post("/reconstruct", content=body(),
+                            headers={"content-type": "multipart/form-data; boundary=x"})
+    assert resp.status_code == 413
+
+
+def test_other_endpoints_are_not_bounded_by_the_upload_limit(small_limit):
+    resp = small_limit.post("/enhance", files={"file": ("f.jpg", _jpeg(padding=_over_body_limit()), "image/jpeg")})
+    assert resp.status_code == 200
+
+
+def test_too_many_files_answers_413(monkeypatch, tmp_path):
+    with _client(monkeypatch, tmp_path, UPLOAD_MAX_FILES="2") as c:
+        resp = c.post("/reconstruct", data={"prompt": "a pot"},
+                      files=[("files", (f"f{i}.jpg", _jpeg(), "image/jpeg")) for i in range(3)])
+    assert resp.status_code == 413
+
+
+def test_file_over_per_file_limit_answers_413(monkeypatch, tmp_path):
+    with _client(monkeypatch, tmp_path, UPLOAD_MAX_FILE_MB="0.01") as c:
+        resp = c.post("/reconstruct", data={"prompt": "a pot"},
+                      files={"files": ("big.jpg", _jpeg(padding=20 * 1024), "image/jpeg")})
+    assert resp.status_code == 413
+    assert "per-file" in resp.json()["detail"]
+
+
+def test_fragments_over_total_limit_answer_413(small_limit):
+    # Each file fits, and so does the body; their sum does not
+    files = [("files", (f"f{i}.jpg", _jpeg(padding=60 * 1024), "image/jpeg")) for i in range(2)]
+    resp = small_limit.post("/reconstruct", data={"prompt": "a pot"}, files=files)
+    assert resp.status_code == 413
+    assert "total" in resp.json()["detail"]
+
+
+def test_fragment_over_pixel_limit_answers_413(monkeypatch, tmp_path):
+    with _client(monkeypatch, tmp_path, FRAGMENT_MAX_PIXELS="1000") as c:
+        resp = c.post("/reconstruct", data={"prompt": "a pot"},
+                      files={"files": ("f.jpg", _jpeg(), "image/jpeg")})
+    assert resp.status_code == 413
+
+
+def test_gif_fragment_is_accepted(small_limit):
+    buf = io.BytesIO()
+    Image.radial_gradient("L").resize((64, 64)).save(buf, format="GIF")
+    resp = small_limit.post("/reconstruct", data={"prompt": "a pot"},
+                            files={"files": ("f.gif", buf.getvalue(), "image/gif")})
+    assert resp.status_code == 200
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+from jobs import JobQueue, QueueFull
+
+
+async def _blocked(release):
+    await release.wait()
+    return b"x" * 100
+
+
+def test_full_queue_rejects_then_admits_after_cancel():
+    async def run():
+        release = asyncio.Event()
+        queue = JobQueue(workers=1, max_queue=2)
+        queue.start()
+        try:
+            running = queue.submit(lambda: _blocked(release))
+            await asyncio.sleep(0)  # the worker picks it up
+            waiting = [queue.submit(lambda: _blocked(release)) for _ in range(2)]
+            with pytest.raises(QueueFull):
+                queue.submit(lambda: _blocked(release))
+            assert queue.counters["rejected"] == 1
+
+            assert queue.cancel(waiting[0])
+            assert queue.stats()["queued"] == 1
+            admitted = queue.submit(lambda: _blocked(release))
+
+            release.set()
+            for job in (running, waiting[1], admitted):
+                await asyncio.wait_for(job.done.wait(), 1)
+            return running, waiting, admitted, queue.stats()
+        finally:
+            await queue.stop()
+
+    running, waiting, admitted, stats = asyncio.run(run())
+    assert waiting[0].status == "cancelled"
+    assert [j.status for j in (running, waiting[1], admitted)] == ["succeeded"] * 3
+    assert stats["queued"] == 0 and stats["cancelled"] == 1 and stats["succeeded"] == 3
+
+
+def test_cancel_running_job():
+    async def run():
+        queue = JobQueue(workers=1, max_queue=2)
+        queue.start()
+        try:
+            job = queue.submit(lambda: asyncio.sleep(10))
+            await asyncio.sleep(0.01)
+            assert job.status == "running"
+            assert queue.cancel(job)
+            await asyncio.wait_for(job.done.wait(), 1)
+            # Finished jobs cannot be cancelled again
+            return job, queue.cancel(job)
+        finally:
+            await queue.stop()
+
+    job, again = asyncio.run(run())
+    assert job.status == "cancelled" and again is False
+
+
+def test_cancelled_queued_job_stops_waiting():
+    async def run():
+        release = asyncio.Event()
+        queue = JobQueue(workers=1, max_queue=2)
+        queue.start()
+        try:
+            queue.submit(lambda: _blocked(release))
+            await asyncio.sleep(0)
+            job = queue.submit(lambda: _blocked(release))
+            await asyncio.sleep(0.02)
+            queue.cancel(job)
+            wait = job.queue_wait
+            await asyncio.sleep(0.05)
+            return wait, job.queue_wait
+        finally:
+            release.set()
+            await queue.stop()
+
+    before, after = asyncio.run(run())
+    assert before == after
+
+
+def test_retention_caps_evict_oldest_finished_jobs():
+    async def run():
+        queue = JobQueue(workers=2, max_queue=10, max_retained=3, max_bytes=250, sizeof=len)
+        queue.start()
+        try:
+            jobs = []
+            for _ in range(5):
+                jobs.append(queue.submit(lambda: asyncio.sleep(0, b"x" * 100)))
+                await asyncio.wait_for(jobs[-1].done.wait(), 1)
+            return queue, jobs
+        finally:
+            await queue.stop()
+
+    queue, jobs = asyncio.run(run())
+    # 250 bytes hold two 100 byte results; the three oldest were evicted
+    assert [queue.get(j.id) is not None for j in jobs] == [False, False, False, True, True]
+    assert queue.stats()["retained_bytes"] == 200
+    assert queue.counters["evicted"] == 3
+
+
+def test_expired_jobs_are_pruned():
+    async def run():
+        queue = JobQueue(workers=1, max_queue=2, ttl=3600)
+        queue.start()
+        try:
+            job = queue.submit(lambda: asyncio.sleep(0, b"x"))
+            await asyncio.wait_for(job.done.wait(), 1)
+            job.finished_at -= 7200
+            queue._prune()
+            return queue, job
+        finally:
+            await queue.stop()
+
+    queue, job = asyncio.run(run())
+    assert queue.get(job.id) is None
@@ -0,0 +1,74 @@
+import asyncio
+import base64
+import functools
+import time
+
+import httpx
+
+import providers
+
+IMAGE = b"\x89PNG" + b"\0" * providers.MIN_IMAGE_BYTES
+
+
+def _mock_clients(handlers):
+    for name, handler in handlers.items():
+        providers._clients[name] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+async def _close_clients(names):
+    for name in names:
+        await providers._clients.pop(name).aclose()
+
+
+def test_backoff_past_deadline_skips_to_next_attempt():
+    hf_calls = []
+
+    def hf(request):
+        hf_calls.append(request.url)
+        return httpx.Response(503, json={"error": "Model is loading"})
+
+    def openai(request):
+        return httpx.Response(200, json={"data": [{"b64_json": base64.b64encode(IMAGE).decode()}]})
+
+    async def run():
+        _mock_clients({"hf": hf, "openai": openai})
+        plan = providers.compile_plan((
+            ("hf", "test/backoff-model", (("attempts", 3), ("timeout", 30))),
+            ("openai", "gpt-image-1", ()),
+        ))
+        credentials = {"openai": "key", "replicate": None, "hf": "key"}
+        steps = [(a.provider, functools.partial(providers.run_attempt, a, credentials, "a pot")) for a in plan]
+        # The first HF retry would back off 5s, past the 2s budget
+        token = providers.current_deadline.set(providers.Deadline(2))
+        try:
+            start = time.monotonic()
+            result = await providers.run_chain(steps)
+            return result, time.monotonic() - start
+        finally:
+            providers.current_deadline.reset(token)
+            await _close_clients(["hf", "openai"])
+
+    result, elapsed = asyncio.run(run())
+    assert result == (IMAGE, "openai:gpt-image-1")
+    assert len(hf_calls) == 1
+    assert elapsed < 1
+
+
+def test_hf_json_image_is_validated_once(monkeypatch):
+    events = []
+    monkeypatch.setattr(providers.progress, "emit", lambda event, **data: events.append(event))
+
+    def hf(request):
+        # Base64 PNG embedded in a JSON object, as some HF models answer
+        return httpx.Response(200, json={"image": base64.b64encode(IMAGE).decode()})
+
+    async def run():
+        _mock_clients({"hf": hf})
+        try:
+            return await providers.hf_generate("key", "a pot", "test/json-model", attempts=1)
+        finally:
+            await _close_clients(["hf"])
+
+    result = asyncio.run(run())
+    assert result == (IMAGE, "hf:test/json-model")
+    assert events.count("validated") == 1
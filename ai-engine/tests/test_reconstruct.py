@@ -0,0 +1,62 @@
+import io
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+import settings
+
+
+def _jpeg(side=64):
+    buf = io.BytesIO()
+    Image.radial_gradient("L").resize((side, side)).convert("RGB").save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    env = {"OPENAI_API_KEY": "", "REPLICATE_API_TOKEN": "", "HF_API_KEY": "", "WARMUP": "false",
+           "RECONSTRUCT_CACHE": "false", "RECONSTRUCT_PERSIST": "false", "RECONSTRUCT_OUTPUT_DIR": str(tmp_path)}
+    for name, value in env.items():
+        monkeypatch.setitem(settings._PROCESS_ENV, name, value)
+    monkeypatch.chdir(tmp_path)
+    with TestClient(main.app) as c:
+        yield c
+
+
+def test_result_is_returned_from_memory(client, tmp_path):
+    resp = client.post("/reconstruct", data={"prompt": "a pot"},
+                       files={"files": ("f.jpg", _jpeg(), "image/jpeg")})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "image/png"
+    assert resp.headers["x-reconstruct-source"] == "placeholder"
+    assert Image.open(io.BytesIO(resp.content)).size == (1024, 1024)
+    # Nothing is written next to the engine or to the output directory
+    assert os.listdir(tmp_path) == []
+
+
+def test_persisted_result_is_named_in_the_response(client, tmp_path):
+    resp = client.post("/reconstruct", data={"prompt": "a pot", "persist": "true"},
+                       files={"files": ("f.jpg", _jpeg(), "image/jpeg")})
+    assert resp.status_code == 200
+    saved = resp.headers["x-output-file"]
+    assert saved in os.listdir(tmp_path)
+
+
+@pytest.mark.parametrize("field", [{"quality": "0"}, {"max_side": "0"}, {"quality": "150"}])
+def test_explicit_out_of_range_output_fields_answer_400(client, field):
+    resp = client.post("/reconstruct", data={"prompt": "a pot", **field},
+                       files={"files": ("f.jpg", _jpeg(), "image/jpeg")})
+    assert resp.status_code == 400
+
+
+def test_accept_png_serves_png_result_unchanged(client):
+    def post(**headers):
+        return client.post("/reconstruct", data={"prompt": "a pot"}, headers=headers,
+                           files={"files": ("f.jpg", _jpeg(), "image/jpeg")})
+
+    plain, negotiated = post(), post(accept="image/png")
+    assert negotiated.status_code == 200
+    assert negotiated.content == plain.content
@@ -0,0 +1,96 @@
+import pytest
+
+import routing
+from routing import CLOSED, HALF_OPEN, OPEN, Router
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(routing.time, "monotonic", clock)
+    return clock
+
+
+def _state(router, model="m"):
+    return next(s["state"] for s in router.stats() if s["model"] == model)
+
+
+def _fail(router, times, model="m", **kwargs):
+    for _ in range(times):
+        router.record("hf", model, False, 1.0, error="500", **kwargs)
+
+
+def test_breaker_opens_after_threshold(clock):
+    router = Router(failure_threshold=3, cooldown=60)
+    _fail(router, 2)
+    assert _state(router) == CLOSED and router.allow("hf", "m")
+    _fail(router, 1)
+    assert _state(router) == OPEN
+    assert not router.allow("hf", "m")
+
+
+def test_half_open_probe_success_closes(clock):
+    router = Router(failure_threshold=3, cooldown=60)
+    _fail(router, 3)
+    clock.now += 60
+    assert _state(router) == HALF_OPEN
+    # Only one probe at a time
+    assert router.allow("hf", "m")
+    assert not router.allow("hf", "m")
+    router.record("hf", "m", True, 2.0)
+    assert _state(router) == CLOSED
+    assert router.allow("hf", "m") and router.allow("hf", "m")
+
+
+def test_half_open_probe_failure_reopens_with_longer_cooldown(clock):
+    router = Router(failure_threshold=3, cooldown=60)
+    _fail(router, 3)
+    clock.now += 60
+    assert router.allow("hf", "m")
+    _fail(router, 1)
+    assert _state(router) == OPEN
+    clock.now += 60
+    assert _state(router) == OPEN
+    clock.now += 60
+    assert _state(router) == HALF_OPEN
+
+
+def test_hard_failure_opens_immediately(clock):
+    router = Router(failure_threshold=3)
+    _fail(router, 1, hard=True)
+    assert _state(router) == OPEN
+
+
+def test_model_loading_does_not_open_the_breaker(clock):
+    router = Router(failure_threshold=3)
+    _fail(router, 5, neutral=True)
+    assert _state(router) == CLOSED
+    stats = router.stats()[0]
+    assert stats["busy"] == 5 and stats["attempts"] == 0 and stats["consecutive_failures"] == 0
+
+
+def test_loading_reply_frees_the_half_open_probe(clock):
+    router = Router(failure_threshold=3, cooldown=60)
+    _fail(router, 3)
+    clock.now += 60
+    assert router.allow("hf", "m")
+    _fail(router, 1, neutral=True)
+    assert _state(router) == HALF_OPEN
+    assert router.allow("hf", "m")
+
+
+def test_order_prefers_faster_models_and_skips_open_ones(clock):
+    router = Router(failure_threshold=1)
+    for _ in range(5):
+        router.record("hf", "slow", True, 20.0)
+        router.record("hf", "fast", True, 2.0)
+    _fail(router, 1, model="broken")
+    assert router.order("hf", ["slow", "broken", "fast", "slow"]) == ["fast", "slow"]
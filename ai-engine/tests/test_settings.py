@@ -0,0 +1,35 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import settings
+from settings import Settings, SettingsError
+
+
+@pytest.mark.parametrize("env", [
+    {"OUTPUT_QUALITY": "0"},
+    {"OUTPUT_QUALITY": "150"},
+    {"OUTPUT_MAX_SIDE": "8"},
+    {"OUTPUT_MAX_SIDE": "100000"},
+    {"THUMBNAIL_SIDES": "256,100000"},
+])
+def test_out_of_range_output_settings_are_rejected(env):
+    with pytest.raises(SettingsError, match=next(iter(env))):
+        Settings(env)
+
+
+def test_output_settings_in_range():
+    cfg = Settings({"OUTPUT_QUALITY": "100", "OUTPUT_MAX_SIDE": "2048"})
+    assert (cfg.output_quality, cfg.output_max_side) == (100, 2048)
+    assert Settings({"OUTPUT_MAX_SIDE": "0"}).output_max_side == 0
+
+
+def test_reload_keeps_settings_when_output_quality_is_invalid(monkeypatch):
+    for name, value in {"ADMIN_TOKEN": "token", "WARMUP": "false", "RECONSTRUCT_CACHE": "false"}.items():
+        monkeypatch.setitem(settings._PROCESS_ENV, name, value)
+    with TestClient(main.app) as client:
+        monkeypatch.setitem(settings._PROCESS_ENV, "OUTPUT_QUALITY", "150")
+        resp = client.post("/admin/reload", headers={"X-Admin-Token": "token"})
+        assert resp.status_code == 400
+        assert "OUTPUT_QUALITY" in resp.json()["detail"]
+        assert main.settings.output_quality == 80
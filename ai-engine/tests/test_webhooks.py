@@ -0,0 +1,77 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+import providers
+import settings
+
+SECRET = "whsec_" + base64.b64encode(b"test webhook signing key").decode()
+
+
+def _signed_headers(body, secret=SECRET, timestamp=None, msg_id="msg_1"):
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    key = base64.b64decode(secret.split("_", 1)[1])
+    digest = hmac.new(key, f"{msg_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+    return {
+        "webhook-id": msg_id,
+        "webhook-timestamp": timestamp,
+        "webhook-signature": "v1," + base64.b64encode(digest).decode(),
+    }
+
+
+def test_valid_signature_is_accepted():
+    body = b'{"id": "p1", "status": "succeeded"}'
+    assert providers.verify_replicate_webhook(_signed_headers(body), body, SECRET)
+
+
+def test_tampered_body_is_rejected():
+    body = b'{"id": "p1", "status": "succeeded"}'
+    headers = _signed_headers(body)
+    assert not providers.verify_replicate_webhook(headers, body.replace(b"p1", b"p2"), SECRET)
+
+
+def test_wrong_secret_is_rejected():
+    body = b"{}"
+    other = "whsec_" + base64.b64encode(b"some other key").decode()
+    assert not providers.verify_replicate_webhook(_signed_headers(body, secret=other), body, SECRET)
+
+
+def test_expired_timestamp_is_rejected():
+    body = b"{}"
+    headers = _signed_headers(body, timestamp=time.time() - 3600)
+    assert not providers.verify_replicate_webhook(headers, body, SECRET)
+
+
+def test_missing_headers_are_rejected():
+    assert not providers.verify_replicate_webhook({}, b"{}", SECRET)
+
+
+def test_endpoint_checks_signatures(monkeypatch):
+    for name, value in {"REPLICATE_WEBHOOK_SECRET": SECRET, "WARMUP": "false"}.items():
+        monkeypatch.setitem(settings._PROCESS_ENV, name, value)
+    body = json.dumps({"id": "p-webhook-test", "status": "succeeded"}).encode()
+    with TestClient(main.app) as client:
+        assert client.post("/webhooks/replicate", content=body).status_code == 401
+        resp = client.post("/webhooks/replicate", content=body, headers=_signed_headers(body))
+        assert resp.status_code == 200
+    assert providers._replicate_early.pop("p-webhook-test")["status"] == "succeeded"
+
+
+def test_endpoint_is_off_without_a_secret(monkeypatch):
+    monkeypatch.setitem(settings._PROCESS_ENV, "REPLICATE_WEBHOOK_SECRET", "")
+    monkeypatch.setitem(settings._PROCESS_ENV, "WARMUP", "false")
+    body = b'{"id": "p1"}'
+    with TestClient(main.app) as client:
+        assert client.post("/webhooks/replicate", content=body, headers=_signed_headers(body)).status_code == 404
+
+
+def test_outputs_are_only_fetched_from_replicate_hosts():
+    assert providers.is_replicate_output_url("https://pbxt.replicate.delivery/abc/out.png")
+    assert not providers.is_replicate_output_url("http://pbxt.replicate.delivery/abc/out.png")
+    assert not providers.is_replicate_output_url("https://replicate.delivery.example.com/out.png")
+    assert not providers.is_replicate_output_url("https://169.254.169.254/latest/meta-data")
@@ -5,6 +5,12 @@ const FormData = require('form-data');
 
 const AI_ENGINE_URL = process.env.AI_ENGINE_URL || 'http://127.0.0.1:8001';
 const UPLOAD_DIR = process.env.UPLOAD_DIR || 'uploads';
+const IMAGE_EXTENSIONS = {
+  'image/png': '.png',
+  'image/jpeg': '.jpg',
+  'image/webp': '.webp',
+  'image/avif': '.avif',
+};
 
 // Process the uploaded image, call AI engine, save result and return URL
 exports.startProcess = async (req, res) => {
@@ -25,8 +31,6 @@ exports.startProcess = async (req, res) => {
     } catch (e) {}
 
     const jobId = Date.now().toString();
-    const restoredFilename = `restored-${jobId}${path.extname(req.file.originalname) || '.png'}`;
-    const restoredPath = path.join(UPLOAD_DIR, restoredFilename);
 
     try {
       // Prefer AI_ENGINE_URL if it points to port 8001, otherwise force localhost:8001
@@ -69,6 +73,11 @@ exports.startProcess = async (req, res) => {
         }
       }
 
+      // The engine may re-encode (OUTPUT_FORMAT / Accept), so name the file by what it sent
+      const ext = IMAGE_EXTENSIONS[contentType.split(';')[0].trim()] || '.png';
+      const restoredFilename = `restored-${jobId}${ext}`;
+      const restoredPath = path.join(UPLOAD_DIR, restoredFilename);
+
       // Pipe response to file when it looks like a valid image stream
       const writer = fs.createWriteStream(restoredPath);
       aiResp.data.pipe(writer);